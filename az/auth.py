@@ -1,8 +1,11 @@
 import os.path
 import json
-import adal
-from msrestazure.azure_active_directory import AdalAuthentication
 from ..common.cacher import cache
+from ..common.lazy import LazyModule
+from .tokencache import TokenCache
+from .connections import ConnectionPool, PooledCredentials
+
+adal = LazyModule('adal')
 
 class Auth(object):
     '''Wraps the AAD authentication of Azure users and is a factory for
@@ -23,12 +26,19 @@ class Auth(object):
     Default location is ~/.azure/saje.json but you can override by
     setting SAJE_AUTH_CONFIG in your environment or supply it to
     the constructor.
+
+    Access tokens are kept in a TokenCache shared between processes;
+    pass token_cache=False to always ask AAD.
+
+    All clients made share one keep-alive ConnectionPool, sized by
+    pool_connections (hosts) and pool_maxsize (connections per host).
     '''
 
     default_config = os.path.expanduser('~/.azure/saje.json')
     login_endpoint = 'https://login.microsoftonline.com/'
 
-    def __init__(self, name='default', config_path=None):
+    def __init__(self, name='default', config_path=None, token_cache=None,
+                 pool_connections=None, pool_maxsize=None):
         if config_path is None:
             config_path = os.environ.get('SAJE_AUTH_CONFIG', self.default_config)
 
@@ -54,58 +64,75 @@ class Auth(object):
 
         self.context = adal.AuthenticationContext(self.login_endpoint + self.tenant_id)
         self._resource_credentials = {}
+        if token_cache is None:
+            token_cache = TokenCache()
+        self.token_cache = token_cache
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+
+    def _AcquireToken(self, resource, client_id, secret):
+        if not self.token_cache:
+            return self.context.acquire_token_with_client_credentials(resource, client_id, secret)
+        return self.token_cache.acquire(self.context, self.tenant_id, resource, client_id, secret)
 
     def GetCredentialsForResource(self, resource):
         try:
             return self._resource_credentials[resource]
         except KeyError:
-            ans = AdalAuthentication(self.context.acquire_token_with_client_credentials,
-                                     resource, self.client_id, self.secret)
+            from msrestazure.azure_active_directory import AdalAuthentication
+            ans = PooledCredentials(AdalAuthentication(self._AcquireToken,
+                                                       resource, self.client_id, self.secret),
+                                    self.ConnectionPool)
             self._resource_credentials[resource] = ans
             return ans
     @property
+    @cache
+    def ConnectionPool(self):
+        return ConnectionPool(self.pool_connections, self.pool_maxsize)
+
+    @property
     def ManagementCredentials(self):
         return self.GetCredentialsForResource('https://management.azure.com/')
 
     @cache
     def ResourceManagementClient(self):
         from azure.mgmt.resource import ResourceManagementClient
-        return ResourceManagementClient(self.ManagementCredentials, self.subscription_id)
+        return self.ConnectionPool.attach(ResourceManagementClient(self.ManagementCredentials, self.subscription_id))
 
     @cache
     def StorageManagementClient(self):
         from azure.mgmt.storage import StorageManagementClient
-        return StorageManagementClient(self.ManagementCredentials, self.subscription_id)
+        return self.ConnectionPool.attach(StorageManagementClient(self.ManagementCredentials, self.subscription_id))
 
     @cache
     def ComputeManagementClient(self):
         from azure.mgmt.compute import ComputeManagementClient
-        return ComputeManagementClient(self.ManagementCredentials, self.subscription_id)
+        return self.ConnectionPool.attach(ComputeManagementClient(self.ManagementCredentials, self.subscription_id))
 
     @cache
     def BatchManagementClient(self):
         from azure.mgmt.batch import BatchManagementClient
-        return BatchManagementClient(self.ManagementCredentials, self.subscription_id)
+        return self.ConnectionPool.attach(BatchManagementClient(self.ManagementCredentials, self.subscription_id))
     def BatchServiceClient(self, base_url=None):
         from azure.batch import BatchServiceClient
-        return BatchServiceClient(self.GetCredentialsForResource('https://batch.core.windows.net/'), base_url=base_url)
+        return self.ConnectionPool.attach(BatchServiceClient(self.GetCredentialsForResource('https://batch.core.windows.net/'), base_url=base_url))
 
     @cache
     def NetworkManagementClient(self):
         from azure.mgmt.network import NetworkManagementClient
-        return NetworkManagementClient(self.ManagementCredentials, self.subscription_id)
+        return self.ConnectionPool.attach(NetworkManagementClient(self.ManagementCredentials, self.subscription_id))
 
     @cache
     def KeyVaultManagementClient(self):
         from azure.mgmt.keyvault import KeyVaultManagementClient
-        return KeyVaultManagementClient(self.ManagementCredentials, self.subscription_id)
+        return self.ConnectionPool.attach(KeyVaultManagementClient(self.ManagementCredentials, self.subscription_id))
 
     @cache
     def AuthorizationManagementClient(self):
         from azure.mgmt.authorization import AuthorizationManagementClient
-        return AuthorizationManagementClient(self.ManagementCredentials, self.subscription_id)
+        return self.ConnectionPool.attach(AuthorizationManagementClient(self.ManagementCredentials, self.subscription_id))
     @cache
     def GraphRbacManagementClient(self):
         from azure.graphrbac import GraphRbacManagementClient
-        return GraphRbacManagementClient(self.GetCredentialsForResource('https://graph.windows.net/'), self.tenant_id)
+        return self.ConnectionPool.attach(GraphRbacManagementClient(self.GetCredentialsForResource('https://graph.windows.net/'), self.tenant_id))
     pass
@@ -2,10 +2,14 @@ from __future__ import print_function, unicode_literals
 import re
 import hashlib
 
-from azure.batch import models
+from ..common.lazy import LazyModule
 from ..status import StatusReporter
 from .auth import Auth
 from .storage import StorageAccount, BlobService
+from .metadata import MetadataCache
+from ..common.cacher import cache
+
+models = LazyModule('azure.batch.models')
 
 def DemangleId(az_id):
     """Unpack an Azure ID string, at least partially.
@@ -66,31 +70,71 @@ def JobContainerName(job_id):
     return 'job-' + c_name +'-' + sha1
 
 class Helper(StatusReporter):
-    def __init__(self, group_name, batch_name, cred_name='batch', verbosity=1):
+    '''Clients for a Batch account and its auto-storage account.
+
+    The account endpoint, storage account name and key are kept in a
+    MetadataCache for metadata_ttl seconds, so that constructing a
+    Helper normally makes no ARM requests at all. Call
+    InvalidateMetadata after rotating the storage keys.
+    '''
+    def __init__(self, group_name, batch_name, cred_name='batch', verbosity=1,
+                 pool_connections=None, pool_maxsize=None, metadata_ttl=None):
         self.verbosity = verbosity
         
-        self.auth = Auth(cred_name)
+        self.auth = Auth(cred_name, pool_connections=pool_connections, pool_maxsize=pool_maxsize)
         
         self.group = group_name
         self.name = batch_name
 
-        self.debug('Getting batch account info')
-        self.manager = self.auth.BatchManagementClient()
-        self.account = self.manager.batch_account.get(self.group, self.name)
+        self.metadata_cache = MetadataCache(ttl=metadata_ttl)
+        self.metadata_key = MetadataCache.Key(self.auth.subscription_id, self.group, self.name)
+        meta = self.metadata_cache.get(self.metadata_key)
+        if meta is None:
+            meta = self._FetchMetadata()
+            self.metadata_cache.put(self.metadata_key, meta)
+        else:
+            self.debug('Using cached batch account info')
+
+        self.url = meta['url']
+        self.debug('Batch URL:', self.url)
+        self.debug('Opening storage account', meta['storage_name'])
+        self.storage = StorageAccount.FromKey(meta['storage_name'], meta['storage_key'],
+                                              self.auth.ConnectionPool.session)
         
+        self.debug('Creating batch client')
+        self.client = self.auth.BatchServiceClient(base_url=self.url)
+
+    @property
+    @cache
+    def manager(self):
+        return self.auth.BatchManagementClient()
+
+    @property
+    @cache
+    def account(self):
+        return self.manager.batch_account.get(self.group, self.name)
+
+    def _FetchMetadata(self):
+        self.debug('Getting batch account info')
         batch_url = self.account.account_endpoint
         if not batch_url.startswith('https://'):
             batch_url = 'https://' + batch_url
-        self.debug('Batch URL:', batch_url)
-        self.url = batch_url
 
         storage_id = self.account.auto_storage.storage_account_id
         storage_name = DemangleId(storage_id)['name']
-        
-        self.debug('Opening storage account', storage_name)
-        self.storage = StorageAccount.open(self.auth, self.group, storage_name)
-        
-        self.debug('Creating batch client')
-        self.client = self.auth.BatchServiceClient(base_url=batch_url)
+        storage = StorageAccount.open(self.auth, self.group, storage_name)
+        return {'url': batch_url,
+                'storage_name': storage_name,
+                'storage_key': storage.key}
+
+    def InvalidateMetadata(self):
+        '''Forget the cached metadata, e.g. after rotating keys, and
+        reopen the storage account with fresh keys.
+        '''
+        self.metadata_cache.invalidate(self.metadata_key)
+        meta = self._FetchMetadata()
+        self.metadata_cache.put(self.metadata_key, meta)
+        self.storage = StorageAccount.FromKey(meta['storage_name'], meta['storage_key'],
+                                              self.auth.ConnectionPool.session)
     
     
@@ -0,0 +1,89 @@
+from __future__ import print_function, unicode_literals
+
+class ConnectionPool(object):
+    '''A keep-alive HTTP connection pool to be shared by all the
+    clients made by one Auth, so that they reuse warm TLS connections
+    to the same endpoints instead of each opening their own.
+
+    pool_connections is the number of distinct hosts to keep pools
+    for, pool_maxsize the number of connections kept per host; make
+    the latter at least as large as the number of worker threads used
+    for transfers.
+    '''
+    default_pool_connections = 16
+    default_pool_maxsize = 32
+    default_max_retries = 3
+
+    def __init__(self, pool_connections=None, pool_maxsize=None, max_retries=None):
+        import requests
+        self.adapter = requests.adapters.HTTPAdapter(
+            pool_connections=pool_connections or self.default_pool_connections,
+            pool_maxsize=pool_maxsize or self.default_pool_maxsize,
+            max_retries=self.default_max_retries if max_retries is None else max_retries)
+        self.session = self.mount(requests.Session())
+
+    def mount(self, session, adapter=None):
+        adapter = adapter or self.adapter
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
+
+    def owns(self, session):
+        '''Whether a session already uses the shared connections'''
+        adapter = session.adapters.get('https://')
+        return getattr(adapter, 'poolmanager', None) is self.adapter.poolmanager
+
+    def client_adapter(self, max_retries=None):
+        '''An adapter on the shared connections with its own retry
+        policy. Closing it leaves the connections open for the others.
+        '''
+        import requests
+        adapter = requests.adapters.HTTPAdapter(
+            max_retries=self.adapter.max_retries if max_retries is None else max_retries)
+        adapter.poolmanager = self.adapter.poolmanager
+        adapter.close = lambda: None
+        return adapter
+
+    def attach(self, client):
+        '''Make an msrest based SDK client use the shared connections,
+        keeping the retry policy it was configured with.
+        '''
+        import requests
+        service_client = getattr(client, '_client', client)
+        config = getattr(service_client, 'config', None)
+        max_retries = None
+        if config is not None:
+            # Else msrest closes its session, and with it the shared
+            # connections, after every request
+            config.keep_alive = True
+            retry_policy = getattr(config, 'retry_policy', None)
+            if callable(retry_policy):
+                max_retries = retry_policy()
+        adapter = self.client_adapter(max_retries)
+        if hasattr(service_client, '_adapter'):
+            service_client._adapter = adapter
+        else:
+            service_client._session = self.mount(requests.Session(), adapter)
+        return client
+    pass
+
+class PooledCredentials(object):
+    '''Wraps msrest credentials so that every session they sign is
+    mounted on the shared connection pool.
+    '''
+    def __init__(self, creds, pool):
+        self.creds = creds
+        self.pool = pool
+
+    def signed_session(self, session=None):
+        if session is None:
+            session = self.creds.signed_session()
+        else:
+            session = self.creds.signed_session(session)
+        if self.pool.owns(session):
+            return session
+        return self.pool.mount(session)
+
+    def __getattr__(self, name):
+        return getattr(self.creds, name)
+    pass
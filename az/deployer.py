@@ -1,7 +1,9 @@
 import json
 import time
-from azure.mgmt.resource.resources.models import DeploymentMode
 from ..status import StatusReporter
+from ..common.lazy import LazyModule
+
+resource_models = LazyModule('azure.mgmt.resource.resources.models')
 
 
 class Deployer(StatusReporter):
@@ -30,7 +32,7 @@ class Deployer(StatusReporter):
             template = json.load(template_file_fd)
 
         deployment_properties = {
-            'mode': DeploymentMode.incremental,
+            'mode': resource_models.DeploymentMode.incremental,
             'template': template,
             'parameters': {k: {'value': v} for k, v in pdict.items()}
         }
@@ -0,0 +1,83 @@
+from __future__ import print_function, unicode_literals
+import os
+import time
+
+from ..common.jsonfile import LockedJsonFile
+
+class MetadataCache(object):
+    '''Persistent cache of Batch account metadata shared between
+    processes: the account endpoint, auto-storage account name and
+    storage key. Entries expire after ttl seconds.
+
+    The file holds storage keys, so it is only readable by its owner.
+    After rotating a key, invalidate the entry (or the whole cache) or
+    wait for it to expire.
+
+    Default location is ~/.azure/saje-metadata.json but you can
+    override by setting SAJE_METADATA_CACHE in your environment or
+    supply it to the constructor.
+    '''
+    default_path = os.path.expanduser('~/.azure/saje-metadata.json')
+    default_ttl = 24 * 3600
+
+    def __init__(self, path=None, ttl=None):
+        if path is None:
+            path = os.environ.get('SAJE_METADATA_CACHE', self.default_path)
+        self.path = path
+        self.ttl = self.default_ttl if ttl is None else ttl
+        self._file = LockedJsonFile(path)
+
+    @staticmethod
+    def Key(subscription_id, group_name, batch_name):
+        return '|'.join((subscription_id, group_name, batch_name))
+
+    def get(self, key):
+        '''Return the cached metadata dict, or None if absent or stale.'''
+        with self._file.locked():
+            entry = self._file.load().get(key)
+        if entry is None or time.time() - entry['time'] > self.ttl:
+            return None
+        return entry['data']
+
+    def put(self, key, data):
+        with self._file.locked():
+            entries = self._file.load()
+            entries[key] = {'time': time.time(), 'data': data}
+            self._file.save(entries)
+
+    def invalidate(self, key=None):
+        '''Forget one account, or everything if key is None.'''
+        with self._file.locked():
+            if key is None:
+                self._file.remove()
+                return
+            entries = self._file.load()
+            if entries.pop(key, None) is not None:
+                self._file.save(entries)
+
+    def forget(self, subscription_id=None, group_name=None, batch_name=None):
+        '''Forget all accounts matching the given parts of the key;
+        None matches anything.
+        '''
+        want = (subscription_id, group_name, batch_name)
+        with self._file.locked():
+            entries = self._file.load()
+            for key in list(entries):
+                if all(w in (None, k) for w, k in zip(want, key.split('|'))):
+                    del entries[key]
+            self._file.save(entries)
+    pass
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Clear cached Batch account metadata, e.g. after rotating storage keys")
+    parser.add_argument("--resource-group", "-g", default=None,
+                        help="Resource group of the batch account to forget (default all)")
+    parser.add_argument("--batch-account", "-b", default=None,
+                        help="Name of the batch account to forget (default all)")
+    parser.add_argument("--subscription-id", "-s", default=None,
+                        help="Subscription of the batch account (default all)")
+    args = parser.parse_args()
+
+    MetadataCache().forget(args.subscription_id, args.resource_group, args.batch_account)
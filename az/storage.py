@@ -1,11 +1,20 @@
 import time, datetime
+import io
 import os.path
 
-from azure.mgmt.storage.models import StorageAccountCreateParameters, Sku, Kind
-from azure.storage import blob
-
-from msrestazure.azure_exceptions import CloudError
 from ..common.cacher import cache
+from ..common.lazy import LazyModule
+
+blob = LazyModule('azure.storage.blob')
+blob_models = LazyModule('azure.storage.blob.models')
+storage_models = LazyModule('azure.mgmt.storage.models')
+
+class AccountRef(object):
+    '''Stands in for azure.mgmt.storage.StorageAccount when all we
+    know is the name'''
+    def __init__(self, name):
+        self.name = name
+    pass
 
 class StorageAccount(object):
     '''Minimal wrapper of an Azure storage account'''
@@ -13,6 +22,7 @@ class StorageAccount(object):
     @staticmethod
     def exists(auth, group_name, account_name):
         '''Query existence of the storage account.'''
+        from msrestazure.azure_exceptions import CloudError
         client = auth.StorageManagementClient()
         try:
             acc = client.storage_accounts.get_properties(group_name, account_name)
@@ -28,7 +38,7 @@ class StorageAccount(object):
         kwargs = {}
         if account_kind == 'BlobStorage':
             kwargs['access_tier'] = access_tier
-        params = StorageAccountCreateParameters(Sku(account_type),
+        params = storage_models.StorageAccountCreateParameters(storage_models.Sku(account_type),
                                                 account_kind,
                                                 location,
                                                 **kwargs)
@@ -37,7 +47,7 @@ class StorageAccount(object):
         acc = request.result()
         key_list = client.storage_accounts.list_keys(group_name,
                                                           account_name)
-        return cls(acc, key_list.keys[0].value)
+        return cls(acc, key_list.keys[0].value, auth.ConnectionPool.session)
 
     @classmethod
     def open(cls, auth, group_name, account_name):
@@ -47,12 +57,22 @@ class StorageAccount(object):
         acc = client.storage_accounts.get_properties(group_name, account_name)
         key_list = client.storage_accounts.list_keys(group_name, account_name)
         
-        return cls(acc, key_list.keys[0].value)
+        return cls(acc, key_list.keys[0].value, auth.ConnectionPool.session)
     
-    def __init__(self, acc, key):
+    @classmethod
+    def FromKey(cls, account_name, key, session=None):
+        '''Factory method: create an instance from a known name and key
+        without asking the management API. Only the name of the
+        delegate account is available.
+        '''
+        return cls(AccountRef(account_name), key, session)
+
+    def __init__(self, acc, key, session=None):
         '''Internal constructor'''
         self.acc = acc
         self.key = key
+        # Shared requests.Session for the blob services, if any
+        self.session = session
         
     def __getattr__(self, name):
         try:
@@ -63,11 +83,13 @@ class StorageAccount(object):
     @property
     @cache
     def block_blob_service(self):
-        return BlobService(blob.BlockBlobService(account_name=self.acc.name, account_key=self.key))
+        return BlobService(blob.BlockBlobService(account_name=self.acc.name, account_key=self.key,
+                                                  request_session=self.session))
     @property
     @cache
     def page_blob_service(self):
-        return BlobService(blob.PageBlobService(account_name=self.acc.name, account_key=self.key))
+        return BlobService(blob.PageBlobService(account_name=self.acc.name, account_key=self.key,
+                                                 request_session=self.session))
 
 class BlobService(object):
     @staticmethod
@@ -126,7 +148,7 @@ class BlobService(object):
     
     def list_containers(self, prefix=None):
         for raw_c in self.blob_service.list_containers(prefix=prefix):
-            yield BlobContainer(self.blob_service, raw_c.name)
+            yield BlobContainer(self.blob_service, raw_c.name, raw_c.properties)
     
     def exists(self, container, blob=None):
         return self.blob_service.exists(container, blob)
@@ -136,17 +158,25 @@ class BlobService(object):
 class BlobContainer(object):
     '''Minimal wrapper of a blob storage container'''
     
-    def __init__(self, blob_service, name):
+    def __init__(self, blob_service, name, properties=None):
         self.blob_service = blob_service
         self.name = name
+        # Only set when obtained by listing the service
+        self.properties = properties
         return
     
-    def upload(self, file_path, blob_name=None):
-        if blob_name is None:
-            blob_name = os.path.basename(file_path)
-            
-        self.blob_service.create_blob_from_path(self.name, blob_name, file_path)
-        return self.url(blob_name)
+    def upload(self, file_path, blob_name=None, block_size=None, max_workers=None, verbosity=0):
+        from .transfer import Uploader
+        up = Uploader(self, block_size=block_size, max_workers=max_workers, verbosity=verbosity)
+        return up.upload(file_path, blob_name)
+
+    def upload_many(self, items, block_size=None, max_workers=None, verbosity=0):
+        '''Concurrently upload (file_path, blob_name) pairs, blob_name
+        may be None to use the file's basename. Returns the URLs.
+        '''
+        from .transfer import Uploader
+        up = Uploader(self, block_size=block_size, max_workers=max_workers, verbosity=verbosity)
+        return up.upload_many(items)
     
     def download(self, blob_name, file_path):
         self.blob_service.get_blob_to_path(self.name, blob_name, file_path)
@@ -159,16 +189,61 @@ class BlobContainer(object):
         blb = self.blob_service.get_blob_to_text(self.name, blob_name)
         return blb.content
     
+    def open_read(self, blob_name, chunk_size=None, buffered=True):
+        '''Open a blob for streaming reads as a binary file-like
+        object, buffering at most chunk_size bytes at a time.
+        '''
+        from .stream import BlobReader
+        raw = BlobReader(self, blob_name, chunk_size=chunk_size)
+        return io.BufferedReader(raw) if buffered else raw
+
+    def open_write(self, blob_name, block_size=None, max_workers=None):
+        '''Open a block blob for streaming writes as a binary
+        file-like object; see stream.BlobWriter for memory bounds.
+        '''
+        from .stream import BlobWriter
+        return BlobWriter(self, blob_name, block_size=block_size, max_workers=max_workers)
+
+    def from_stream(self, blob_name, source, block_size=None, max_workers=None):
+        '''Upload from a file-like object or an iterable of byte
+        strings (e.g. a generator) without staging it on disk.
+        '''
+        from .stream import CopyStream
+        with self.open_write(blob_name, block_size=block_size, max_workers=max_workers) as w:
+            CopyStream(source, w)
+        return self.url(blob_name)
+
+    def to_stream(self, blob_name, sink, chunk_size=None):
+        '''Download into a writable file-like object in bounded chunks.'''
+        from .stream import CopyStream
+        with self.open_read(blob_name, chunk_size=chunk_size, buffered=False) as r:
+            return CopyStream(r, sink, r.chunk_size)
+
     def delete(self, blob_name):
         self.blob_service.delete_blob(self.name, blob_name)
 
-    def copy(self, blob_name, src_url):
-        copy_prop = self.blob_service.copy_blob(self.name, blob_name, src_url)
-        while copy_prop.status == 'pending':
-            time.sleep(1)
-            copy_prop = self.blob_service.get_blob_properties(self.name, blob_name).properties.copy
-            
-        return self.url(blob_name)
+    def touch(self, blob_name):
+        '''Update the blob's last modified time, leaving its contents
+        alone. Replaces any metadata it has.
+        '''
+        self.blob_service.set_blob_metadata(self.name, blob_name,
+                                            {'touched': datetime.datetime.utcnow().strftime('%Y%m%dT%H%M%SZ')})
+
+    def copy(self, blob_name, src_url, ranged=False, timeout_s=None, verbosity=0):
+        '''Server side copy from a URL, waiting for completion. See
+        transfer.Copier for the ranged option.
+        '''
+        from .transfer import Copier
+        return Copier(ranged=ranged, verbosity=verbosity).copy(self, blob_name, src_url, timeout_s)
+
+    def copy_many(self, items, ranged=False, max_workers=None, timeout_s=None, verbosity=0):
+        '''Concurrently copy (blob_name, src_url) pairs into this
+        container, returning the URLs once all are complete.
+        '''
+        from .transfer import Copier
+        copier = Copier(max_workers=max_workers, ranged=ranged, verbosity=verbosity)
+        return copier.copy_many([(self, blob_name, src_url) for blob_name, src_url in items],
+                                timeout_s)
     
     def exists(self, blob_name):
         return self.blob_service.exists(self.name, blob_name)
@@ -0,0 +1,185 @@
+from __future__ import print_function, division
+import io
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from ..common.lazy import LazyModule
+
+blob_models = LazyModule('azure.storage.blob.models')
+
+class BlobReader(io.RawIOBase):
+    '''Read only file-like view of a blob.
+
+    Data is fetched with ranged GETs of at most chunk_size bytes, so
+    memory use is bounded no matter how large the blob is. Supports
+    seeking, so it can be handed to anything expecting a file.
+    '''
+    default_chunk_size = 4 << 20
+
+    def __init__(self, container, blob_name, chunk_size=None):
+        self.container = container
+        self.blob_name = blob_name
+        self.chunk_size = chunk_size or self.default_chunk_size
+        props = container.blob_service.get_blob_properties(container.name, blob_name)
+        self.size = props.properties.content_length
+        # Pin to this version of the blob
+        self.etag = props.properties.etag
+        self._pos = 0
+        self._buf = b''
+        self._buf_start = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence == io.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            raise ValueError('Negative seek position {}'.format(offset))
+        self._pos = offset
+        return self._pos
+
+    def _Fill(self):
+        start = self._pos
+        end = min(start + self.chunk_size, self.size) - 1
+        blb = self.container.blob_service.get_blob_to_bytes(
+            self.container.name, self.blob_name,
+            start_range=start, end_range=end, if_match=self.etag, max_connections=1)
+        self._buf = blb.content
+        self._buf_start = start
+
+    def readinto(self, b):
+        if self._pos >= self.size:
+            return 0
+        offset = self._pos - self._buf_start
+        if offset < 0 or offset >= len(self._buf):
+            self._Fill()
+            offset = 0
+        n = min(len(b), len(self._buf) - offset)
+        b[:n] = self._buf[offset:offset + n]
+        self._pos += n
+        return n
+    pass
+
+class BlobWriter(io.RawIOBase):
+    '''Write only file-like object that streams into a block blob.
+
+    Written data is cut into blocks of block_size which are uploaded on
+    up to max_workers threads while the caller carries on writing. At
+    most max_workers blocks are in flight, after which writes wait, so
+    memory use stays around (max_workers + 1) * block_size. Closing
+    commits the block list; leaving a with block by an exception
+    abandons the upload and leaves any existing blob untouched, as does
+    dropping a writer that was never closed.
+    '''
+    default_block_size = 4 << 20
+    default_max_workers = 4
+
+    def __init__(self, container, blob_name, block_size=None, max_workers=None):
+        self.container = container
+        self.blob_name = blob_name
+        self.block_size = block_size or self.default_block_size
+        max_workers = max_workers or self.default_max_workers
+        self._pool = ThreadPoolExecutor(max_workers=max_workers)
+        self._slots = threading.BoundedSemaphore(max_workers)
+        self._futures = []
+        self._block_ids = []
+        self._buf = bytearray()
+        self._committed = False
+        self.size = 0
+
+    def writable(self):
+        return True
+
+    def _Check(self):
+        for fut in self._futures:
+            if fut.done() and fut.exception() is not None:
+                raise fut.exception()
+
+    def _PutBlock(self, block_id, data):
+        try:
+            self.container.blob_service.put_block(self.container.name, self.blob_name,
+                                                  bytes(data), block_id)
+        finally:
+            self._slots.release()
+
+    def _Submit(self, data):
+        self._Check()
+        block_id = '{:08d}'.format(len(self._block_ids))
+        self._block_ids.append(block_id)
+        self._slots.acquire()
+        self._futures.append(self._pool.submit(self._PutBlock, block_id, data))
+
+    def write(self, b):
+        if self.closed:
+            raise ValueError('write to closed BlobWriter')
+        self._buf += b
+        self.size += len(b)
+        while len(self._buf) >= self.block_size:
+            self._Submit(self._buf[:self.block_size])
+            del self._buf[:self.block_size]
+        return len(b)
+
+    def abort(self):
+        '''Stop without committing; uploaded blocks are discarded by
+        the service after a week.
+        '''
+        self._pool.shutdown(wait=True)
+        self._committed = True
+        super(BlobWriter, self).close()
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if not self._committed:
+                if self._buf:
+                    self._Submit(self._buf)
+                    self._buf = bytearray()
+                self._pool.shutdown(wait=True)
+                for fut in self._futures:
+                    fut.result()
+                self.container.blob_service.put_block_list(
+                    self.container.name, self.blob_name,
+                    [blob_models.BlobBlock(id=b) for b in self._block_ids])
+                self._committed = True
+        finally:
+            self._pool.shutdown(wait=False)
+            super(BlobWriter, self).close()
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is not None:
+            self.abort()
+        else:
+            self.close()
+
+    def __del__(self):
+        # IOBase would close, committing a possibly truncated blob
+        try:
+            if not self.closed:
+                self.abort()
+        except Exception:
+            pass
+    pass
+
+def CopyStream(src, dst, chunk_size=1 << 20):
+    '''Copy from a file-like object, or an iterable of byte strings,
+    into a file-like object. Returns the number of bytes copied.
+    '''
+    n = 0
+    if hasattr(src, 'read'):
+        chunks = iter(lambda: src.read(chunk_size), b'')
+    else:
+        chunks = src
+    for chunk in chunks:
+        dst.write(chunk)
+        n += len(chunk)
+    return n
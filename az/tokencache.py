@@ -0,0 +1,64 @@
+from __future__ import print_function, unicode_literals
+import os
+import time
+
+from ..common.jsonfile import LockedJsonFile
+
+class TokenCache(object):
+    '''Persistent cache of AAD access tokens shared between processes.
+
+    Tokens are keyed by tenant, client and resource and are handed out
+    until refresh_margin seconds before they expire, after which a new
+    one is acquired. Only tokens are stored, never secrets, in a file
+    readable by its owner alone.
+
+    Default location is ~/.azure/saje-tokens.json but you can override
+    by setting SAJE_TOKEN_CACHE in your environment or supply it to the
+    constructor.
+    '''
+    default_path = os.path.expanduser('~/.azure/saje-tokens.json')
+    refresh_margin = 300
+
+    def __init__(self, path=None):
+        if path is None:
+            path = os.environ.get('SAJE_TOKEN_CACHE', self.default_path)
+        self.path = path
+        self._file = LockedJsonFile(path)
+
+    @staticmethod
+    def Key(tenant_id, client_id, resource):
+        return '|'.join((tenant_id, client_id, resource))
+
+    def _Valid(self, entry):
+        return entry is not None and entry['expires_at'] - time.time() > self.refresh_margin
+
+    def get(self, tenant_id, client_id, resource):
+        '''Return a cached token that is not close to expiry, or None.'''
+        with self._file.locked():
+            entry = self._file.load().get(self.Key(tenant_id, client_id, resource))
+        return entry['token'] if self._Valid(entry) else None
+
+    def put(self, tenant_id, client_id, resource, token):
+        expires_at = time.time() + int(token['expiresIn'])
+        with self._file.locked():
+            entries = self._file.load()
+            # Drop anything already expired while we are here
+            entries = {k: v for k, v in entries.items() if v['expires_at'] > time.time()}
+            entries[self.Key(tenant_id, client_id, resource)] = {'token': token,
+                                                                 'expires_at': expires_at}
+            self._file.save(entries)
+
+    def invalidate(self):
+        with self._file.locked():
+            self._file.remove()
+
+    def acquire(self, context, tenant_id, resource, client_id, secret):
+        '''Token for the resource, from the cache if possible, else from
+        AAD via the adal context.
+        '''
+        token = self.get(tenant_id, client_id, resource)
+        if token is None:
+            token = context.acquire_token_with_client_credentials(resource, client_id, secret)
+            self.put(tenant_id, client_id, resource, token)
+        return token
+    pass
@@ -0,0 +1,526 @@
+from __future__ import print_function, division
+import os.path
+import base64
+import hashlib
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from ..common.lazy import LazyModule
+from ..status import StatusReporter
+
+blob_models = LazyModule('azure.storage.blob.models')
+
+def FormatBytes(n):
+    '''Human readable byte count'''
+    for unit in ('B', 'KiB', 'MiB', 'GiB'):
+        if abs(n) < 1024:
+            return '{:.1f} {}'.format(n, unit)
+        n /= 1024
+    return '{:.1f} TiB'.format(n)
+
+class TransferProgress(StatusReporter):
+    '''Thread safe byte counter that periodically reports throughput.
+    '''
+    def __init__(self, label, interval=5.0, verbosity=1):
+        self.verbosity = verbosity
+        self.label = label
+        self.interval = interval
+        self.total = 0
+        self.done = 0
+        self._lock = threading.Lock()
+        self._t0 = time.time()
+        self._last_report = self._t0
+
+    def expect(self, n_bytes):
+        with self._lock:
+            self.total += n_bytes
+
+    def update(self, n_bytes):
+        with self._lock:
+            self.done += n_bytes
+            now = time.time()
+            if now - self._last_report < self.interval:
+                return
+            self._last_report = now
+        self.report()
+
+    @property
+    def rate(self):
+        elapsed = time.time() - self._t0
+        return self.done / elapsed if elapsed > 0 else 0.0
+
+    def report(self):
+        self.info('{}: {} / {} at {}/s'.format(self.label,
+                                               FormatBytes(self.done),
+                                               FormatBytes(self.total),
+                                               FormatBytes(self.rate)))
+
+    def finish(self):
+        self.report()
+        return self.done
+    pass
+
+class _PendingBlob(object):
+    '''Tracks the outstanding blocks of one blob so that whichever
+    worker finishes last can commit the block list.
+    '''
+    def __init__(self, container, blob_name, block_ids):
+        self.container = container
+        self.blob_name = blob_name
+        self.block_ids = block_ids
+        self.remaining = len(block_ids)
+        self._lock = threading.Lock()
+
+    def block_done(self):
+        with self._lock:
+            self.remaining -= 1
+            last = self.remaining == 0
+        if last:
+            self.container.blob_service.put_block_list(
+                self.container.name, self.blob_name,
+                [blob_models.BlobBlock(id=b) for b in self.block_ids])
+        return last
+    pass
+
+class Uploader(StatusReporter):
+    '''Upload files to a blob container on a bounded pool of worker
+    threads.
+
+    Files larger than block_size are split into blocks that are
+    uploaded independently with put_block, then committed with
+    put_block_list once all have arrived. Smaller files are sent with a
+    single request. Blocks from all files share the same pool, so many
+    small files and a few huge ones both keep every worker busy.
+    '''
+    default_block_size = 8 << 20
+    default_max_workers = 8
+    # Limits of the block blob API
+    max_block_size = 100 << 20
+    max_blocks = 50000
+
+    def __init__(self, container, block_size=None, max_workers=None, verbosity=1):
+        self.verbosity = verbosity
+        self.container = container
+        self.block_size = block_size or self.default_block_size
+        self.max_workers = max_workers or self.default_max_workers
+        if self.block_size > self.max_block_size:
+            raise ValueError('Block size may be at most {} bytes'.format(self.max_block_size))
+
+    def _BlockSize(self, size):
+        # Grow the block size if the file would need too many blocks
+        bs = self.block_size
+        while size > bs * self.max_blocks:
+            bs *= 2
+        if bs > self.max_block_size:
+            raise ValueError('File of {} bytes is too large for a block blob'.format(size))
+        return bs
+
+    def _PutBlock(self, pending, path, block_id, offset, length, progress):
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            data = f.read(length)
+        self.container.blob_service.put_block(self.container.name, pending.blob_name,
+                                              data, block_id)
+        progress.update(length)
+        if pending.block_done():
+            self.debug('Committed', pending.blob_name)
+
+    def _PutSmall(self, path, blob_name, size, progress):
+        self.container.blob_service.create_blob_from_path(self.container.name, blob_name, path,
+                                                          max_connections=1)
+        progress.update(size)
+        self.debug('Uploaded', blob_name)
+
+    def upload_many(self, items, progress=None):
+        '''Upload an iterable of (file_path, blob_name) pairs.
+
+        Returns the list of blob URLs in the same order.
+        '''
+        items = [(path, blob_name if blob_name is not None else os.path.basename(path))
+                 for path, blob_name in items]
+        if progress is None:
+            progress = TransferProgress('Upload to ' + self.container.name,
+                                        verbosity=self.verbosity)
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            futures = []
+            for path, blob_name in items:
+                size = os.path.getsize(path)
+                progress.expect(size)
+                if size <= self.block_size:
+                    futures.append(pool.submit(self._PutSmall, path, blob_name, size, progress))
+                    continue
+
+                bs = self._BlockSize(size)
+                offsets = range(0, size, bs)
+                # All block IDs of a blob must have the same length
+                block_ids = ['{:08d}'.format(i) for i in range(len(offsets))]
+                pending = _PendingBlob(self.container, blob_name, block_ids)
+                for block_id, offset in zip(block_ids, offsets):
+                    futures.append(pool.submit(self._PutBlock, pending, path, block_id,
+                                               offset, min(bs, size - offset), progress))
+
+            done, _ = wait(futures)
+            for fut in done:
+                # Re-raise the first worker error, if any
+                fut.result()
+
+        progress.finish()
+        return [self.container.url(blob_name) for _, blob_name in items]
+
+    def upload(self, file_path, blob_name=None, progress=None):
+        return self.upload_many([(file_path, blob_name)], progress=progress)[0]
+    pass
+
+def FileMd5(path):
+    '''Base64 MD5 of a local file, in the form Azure uses for
+    Content-MD5.
+    '''
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for buf in iter(lambda: f.read(1 << 20), b''):
+            md5.update(buf)
+    return base64.b64encode(md5.digest()).decode()
+
+class DownloadManifest(object):
+    '''Record of the blobs fetched into a local directory, stored
+    alongside them as JSON.
+
+    Each entry holds the blob's size, ETag and Content-MD5 (as reported
+    by the service, or computed locally if the service has none) plus
+    whether the local copy is complete. An entry is written before a
+    download starts so that an interrupted partial file can be resumed
+    on a rerun if the blob's ETag has not changed.
+    '''
+    FILENAME = '.saje-manifest.json'
+    save_interval = 10.0
+
+    def __init__(self, root):
+        self.path = os.path.join(root, self.FILENAME)
+        self._lock = threading.Lock()
+        self._last_save = time.time()
+        try:
+            with open(self.path) as f:
+                self.entries = json.load(f)
+        except (IOError, OSError, ValueError):
+            self.entries = {}
+
+    def get(self, blob_name):
+        with self._lock:
+            return self.entries.get(blob_name)
+
+    def record(self, blob_name, size, etag, content_md5, complete):
+        with self._lock:
+            self.entries[blob_name] = {'name': blob_name,
+                                       'size': size,
+                                       'etag': etag,
+                                       'content_md5': content_md5,
+                                       'complete': complete}
+            due = time.time() - self._last_save > self.save_interval
+        if due:
+            self.save()
+
+    def save(self):
+        with self._lock:
+            d = os.path.dirname(self.path)
+            if not os.path.isdir(d):
+                os.makedirs(d)
+            tmp = self.path + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(self.entries, f, indent=1, sort_keys=True)
+            # Atomic on POSIX so a crash never leaves a torn manifest
+            os.rename(tmp, self.path)
+            self._last_save = time.time()
+    pass
+
+class ChecksumError(RuntimeError):
+    pass
+
+class Downloader(StatusReporter):
+    '''Download blobs to local files on a bounded pool of worker
+    threads.
+
+    Work items may come from several containers, so that the outputs
+    of many jobs can share one pool. Paths are used as given and the
+    process working directory is never changed, so several downloaders
+    can run in the same process.
+
+    If a work item carries a DownloadManifest, blobs whose local copy
+    is already complete and whose ETag is unchanged are skipped,
+    partial files are resumed from where they stopped, and the result
+    is checked against the blob's Content-MD5.
+    '''
+    default_max_workers = 8
+
+    def __init__(self, max_workers=None, verify=False, verbosity=1):
+        self.verbosity = verbosity
+        self.max_workers = max_workers or self.default_max_workers
+        # Re-hash files that the manifest says are complete
+        self.verify = verify
+
+    @staticmethod
+    def _LocalSize(path):
+        try:
+            return os.path.getsize(path)
+        except OSError:
+            return None
+
+    def _Plan(self, blob, file_path, manifest):
+        '''Work out how many bytes of the blob are already present
+        locally and can be kept, or None if it is complete.
+        '''
+        if manifest is None:
+            return 0
+        props = blob.properties
+        entry = manifest.get(blob.name)
+        local_size = self._LocalSize(file_path)
+        if entry is None or entry['etag'] != props.etag or local_size is None:
+            return 0
+
+        if entry['complete']:
+            if local_size != props.content_length:
+                return 0
+            if self.verify and FileMd5(file_path) != entry['content_md5']:
+                self.info('Checksum mismatch for', file_path, '- fetching again')
+                return 0
+            return None
+
+        if local_size < props.content_length:
+            return local_size
+        return 0
+
+    def _Get(self, container, blob, file_path, manifest, progress):
+        props = blob.properties
+        size = props.content_length
+        have = self._Plan(blob, file_path, manifest)
+        if have is None:
+            self.debug('Up to date:', file_path)
+            progress.update(size)
+            return
+
+        remote_md5 = props.content_settings.content_md5 if props.content_settings else None
+        if manifest is not None:
+            manifest.record(blob.name, size, props.etag, remote_md5, False)
+
+        if have:
+            self.debug('Resuming', blob.name, 'at byte', have)
+            progress.update(have)
+            container.blob_service.get_blob_to_path(container.name, blob.name, file_path,
+                                                    open_mode='ab',
+                                                    start_range=have, end_range=size - 1,
+                                                    if_match=props.etag,
+                                                    max_connections=1)
+        else:
+            container.blob_service.get_blob_to_path(container.name, blob.name, file_path,
+                                                    if_match=props.etag,
+                                                    max_connections=1)
+        progress.update(size - have)
+
+        if manifest is not None:
+            local_md5 = FileMd5(file_path)
+            if remote_md5 and local_md5 != remote_md5:
+                os.remove(file_path)
+                raise ChecksumError('Content-MD5 mismatch for blob {}'.format(blob.name))
+            manifest.record(blob.name, size, props.etag, local_md5, True)
+        self.debug('Downloaded', blob.name, '->', file_path)
+
+    def download_many(self, items, progress=None):
+        '''Download an iterable of (container, blob, file_path, manifest)
+        tuples, where blob is an entry from listing the container and
+        manifest is a DownloadManifest or None.
+        '''
+        items = list(items)
+        if progress is None:
+            progress = TransferProgress('Download', verbosity=self.verbosity)
+
+        # Make all the containing directories in one pass up front
+        dirs = set(os.path.dirname(os.path.abspath(item[2])) for item in items)
+        for d in sorted(dirs):
+            if not os.path.isdir(d):
+                os.makedirs(d)
+
+        manifests = set(item[3] for item in items if item[3] is not None)
+        try:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+                futures = []
+                for container, blob, file_path, manifest in items:
+                    progress.expect(blob.properties.content_length)
+                    futures.append(pool.submit(self._Get, container, blob, file_path,
+                                               manifest, progress))
+                done, _ = wait(futures)
+                for fut in done:
+                    fut.result()
+        finally:
+            for manifest in manifests:
+                manifest.save()
+
+        progress.finish()
+        return [item[2] for item in items]
+    pass
+
+class CopyError(RuntimeError):
+    pass
+
+class CopyJob(object):
+    '''Handle on one server side copy into a blob'''
+    def __init__(self, container, blob_name, src_url, copy_props):
+        self.container = container
+        self.blob_name = blob_name
+        self.src_url = src_url
+        self.id = copy_props.id
+        self.status = copy_props.status
+        self.copied, self.total = self._Progress(copy_props.progress)
+        self.description = None
+
+    @staticmethod
+    def _Progress(progress):
+        # Service reports "bytes copied/bytes total"
+        if not progress:
+            return 0, 0
+        done, total = progress.split('/')
+        return int(done), int(total)
+
+    def refresh(self):
+        props = self.container.blob_service.get_blob_properties(self.container.name, self.blob_name)
+        copy_props = props.properties.copy
+        self.status = copy_props.status
+        self.copied, self.total = self._Progress(copy_props.progress)
+        self.description = copy_props.status_description
+        return self.status
+
+    @property
+    def pending(self):
+        return self.status == 'pending'
+
+    def cancel(self):
+        self.container.blob_service.abort_copy_blob(self.container.name, self.blob_name, self.id)
+        self.status = 'aborted'
+    pass
+
+class Copier(StatusReporter):
+    '''Copy blobs from URLs into containers, server side.
+
+    Many copies are started at once and then polled together with an
+    exponentially growing interval, reporting the bytes copied so far.
+
+    With ranged=True, sources larger than block_size are instead copied
+    as a set of blocks with put_block_from_url on a pool of worker
+    threads, which is often much faster between accounts. This only
+    makes block blobs, so do not use it for VHDs which must stay page
+    blobs. The source URL must be readable without further credentials
+    (e.g. public or carrying a SAS token). With an azure-storage-blob
+    too old for put_block_from_url, every copy is a plain copy_blob.
+    '''
+    default_max_workers = 8
+    default_block_size = 100 << 20
+    min_poll = 1.0
+    max_poll = 30.0
+    backoff = 1.5
+
+    def __init__(self, max_workers=None, block_size=None, ranged=False, verbosity=1):
+        self.verbosity = verbosity
+        self.max_workers = max_workers or self.default_max_workers
+        self.block_size = block_size or self.default_block_size
+        self.ranged = ranged
+
+    def start(self, container, blob_name, src_url):
+        copy_props = container.blob_service.copy_blob(container.name, blob_name, src_url)
+        self.debug('Started copy', src_url, '->', blob_name)
+        return CopyJob(container, blob_name, src_url, copy_props)
+
+    def wait(self, jobs, timeout_s=None):
+        '''Poll copy jobs until none are pending. On timeout or
+        interrupt the outstanding copies are cancelled.
+        '''
+        t_max = None if timeout_s is None else time.time() + timeout_s
+        interval = self.min_poll
+        pending = [j for j in jobs if j.pending]
+        try:
+            while pending:
+                time.sleep(interval)
+                interval = min(interval * self.backoff, self.max_poll)
+                for j in pending:
+                    j.refresh()
+                copied = sum(j.copied for j in jobs)
+                total = sum(j.total for j in jobs)
+                self.info('Copied {} / {}'.format(FormatBytes(copied), FormatBytes(total)))
+                pending = [j for j in pending if j.pending]
+                if pending and t_max is not None and time.time() > t_max:
+                    raise CopyError('Timed out waiting for {} copies'.format(len(pending)))
+        except BaseException:
+            for j in pending:
+                self.info('Cancelling copy to', j.blob_name)
+                j.cancel()
+            raise
+
+        failed = [j for j in jobs if j.status != 'success']
+        if failed:
+            raise CopyError('Copy to {} {}: {}'.format(failed[0].blob_name, failed[0].status,
+                                                       failed[0].description))
+        return jobs
+
+    @staticmethod
+    def SourceSize(src_url):
+        import requests
+        resp = requests.head(src_url)
+        resp.raise_for_status()
+        return int(resp.headers['Content-Length'])
+
+    def _CanPutBlockFromUrl(self, container):
+        # Only in azure-storage-blob 1.4 and later
+        if hasattr(container.blob_service, 'put_block_from_url'):
+            return True
+        self.debug('No put_block_from_url in this azure-storage-blob, copying whole blobs')
+        return False
+
+    def _PutBlockFromUrl(self, pending, src_url, block_id, start, end, progress):
+        self.debug('Copying bytes', start, '-', end, 'of', src_url)
+        pending.container.blob_service.put_block_from_url(
+            pending.container.name, pending.blob_name, src_url, block_id,
+            source_range_start=start, source_range_end=end)
+        progress.update(end - start + 1)
+        pending.block_done()
+
+    def _RangedCopy(self, items):
+        progress = TransferProgress('Ranged copy', verbosity=self.verbosity)
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            futures = []
+            for container, blob_name, src_url, size in items:
+                progress.expect(size)
+                offsets = range(0, size, self.block_size)
+                block_ids = ['{:08d}'.format(i) for i in range(len(offsets))]
+                pending = _PendingBlob(container, blob_name, block_ids)
+                for block_id, offset in zip(block_ids, offsets):
+                    end = min(offset + self.block_size, size) - 1
+                    futures.append(pool.submit(self._PutBlockFromUrl, pending, src_url,
+                                               block_id, offset, end, progress))
+            done, _ = wait(futures)
+            for fut in done:
+                fut.result()
+        progress.finish()
+
+    def copy_many(self, items, timeout_s=None):
+        '''Copy an iterable of (container, blob_name, src_url) and
+        return the destination URLs once all are complete.
+        '''
+        items = list(items)
+        ranged = []
+        jobs = []
+        for container, blob_name, src_url in items:
+            if self.ranged and self._CanPutBlockFromUrl(container):
+                size = self.SourceSize(src_url)
+                if size > self.block_size:
+                    ranged.append((container, blob_name, src_url, size))
+                    continue
+            jobs.append(self.start(container, blob_name, src_url))
+
+        if ranged:
+            self._RangedCopy(ranged)
+        self.wait(jobs, timeout_s)
+        return [container.url(blob_name) for container, blob_name, _ in items]
+
+    def copy(self, container, blob_name, src_url, timeout_s=None):
+        return self.copy_many([(container, blob_name, src_url)], timeout_s)[0]
+    pass
@@ -0,0 +1,185 @@
+from __future__ import print_function, unicode_literals
+import os
+import hashlib
+import sqlite3
+import threading
+import time
+
+class HashCache(object):
+    '''Persistent cache of file digests in a sqlite database.
+
+    Entries are keyed by absolute path and digest algorithm and are
+    only trusted while the file's size, mtime and inode still match
+    those recorded, so a modified or replaced file is always re-hashed.
+    The number of entries is bounded; the least recently used are
+    evicted first.
+
+    Default location is ~/.azure/saje-hashes.sqlite but you can
+    override by setting SAJE_HASH_CACHE in your environment or supply
+    it to the constructor.
+    '''
+    default_path = os.path.expanduser('~/.azure/saje-hashes.sqlite')
+    default_max_entries = 100000
+
+    def __init__(self, path=None, max_entries=None):
+        if path is None:
+            path = os.environ.get('SAJE_HASH_CACHE', self.default_path)
+        self.path = path
+        self.max_entries = max_entries or self.default_max_entries
+
+        d = os.path.dirname(os.path.abspath(path))
+        if not os.path.isdir(d):
+            os.makedirs(d)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        with self._db:
+            self._db.execute('''CREATE TABLE IF NOT EXISTS digests (
+                path TEXT NOT NULL,
+                algorithm TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                inode INTEGER NOT NULL,
+                digest TEXT NOT NULL,
+                last_used REAL NOT NULL,
+                PRIMARY KEY (path, algorithm))''')
+            self._db.execute('''CREATE TABLE IF NOT EXISTS set_digests (
+                key TEXT PRIMARY KEY,
+                digest TEXT NOT NULL,
+                last_used REAL NOT NULL)''')
+
+    @staticmethod
+    def FileKey(path):
+        st = os.stat(path)
+        mtime_ns = getattr(st, 'st_mtime_ns', int(st.st_mtime * 1e9))
+        return os.path.abspath(path), st.st_size, mtime_ns, st.st_ino
+
+    def get(self, path, algorithm='sha1'):
+        '''Return the cached digest, or None if absent or stale.'''
+        apath, size, mtime_ns, inode = self.FileKey(path)
+        with self._lock:
+            row = self._db.execute(
+                'SELECT size, mtime_ns, inode, digest FROM digests WHERE path=? AND algorithm=?',
+                (apath, algorithm)).fetchone()
+            if row is None:
+                return None
+            if tuple(row[:3]) != (size, mtime_ns, inode):
+                with self._db:
+                    self._db.execute('DELETE FROM digests WHERE path=? AND algorithm=?',
+                                     (apath, algorithm))
+                return None
+            with self._db:
+                self._db.execute('UPDATE digests SET last_used=? WHERE path=? AND algorithm=?',
+                                 (time.time(), apath, algorithm))
+            return row[3]
+
+    def put(self, path, digest, algorithm='sha1', key=None):
+        '''Store a digest. Pass the key taken before hashing started so
+        that a file modified while being read is not cached as current.
+        '''
+        apath, size, mtime_ns, inode = key or self.FileKey(path)
+        with self._lock:
+            with self._db:
+                self._db.execute('INSERT OR REPLACE INTO digests VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                 (apath, algorithm, size, mtime_ns, inode, digest, time.time()))
+            self._Evict()
+
+    def digest(self, path, compute, algorithm='sha1'):
+        '''Return the digest of path, calling compute(path) on a miss.'''
+        ans = self.get(path, algorithm)
+        if ans is None:
+            key = self.FileKey(path)
+            ans = compute(path)
+            if self.FileKey(path) == key:
+                self.put(path, ans, algorithm, key=key)
+        return ans
+
+    @classmethod
+    def SetKey(cls, salt, paths):
+        '''Key for a digest of several files together, valid only while
+        none of them has changed.
+        '''
+        hasher = hashlib.sha1(salt)
+        for path in paths:
+            hasher.update(repr(cls.FileKey(path)).encode('utf-8'))
+        return hasher.hexdigest()
+
+    def set_digest(self, salt, paths, compute):
+        '''Return a digest of the files in paths together, calling
+        compute() on a miss. salt must capture everything else the
+        digest depends on.
+        '''
+        key = self.SetKey(salt, paths)
+        with self._lock:
+            row = self._db.execute('SELECT digest FROM set_digests WHERE key=?', (key,)).fetchone()
+            if row is not None:
+                with self._db:
+                    self._db.execute('UPDATE set_digests SET last_used=? WHERE key=?',
+                                     (time.time(), key))
+                return row[0]
+        ans = compute()
+        if self.SetKey(salt, paths) == key:
+            with self._lock:
+                with self._db:
+                    self._db.execute('INSERT OR REPLACE INTO set_digests VALUES (?, ?, ?)',
+                                     (key, ans, time.time()))
+                self._Evict()
+        return ans
+
+    def invalidate(self, path=None):
+        '''Forget one file, or everything if path is None.'''
+        with self._lock:
+            with self._db:
+                if path is None:
+                    self._db.execute('DELETE FROM digests')
+                    self._db.execute('DELETE FROM set_digests')
+                else:
+                    self._db.execute('DELETE FROM digests WHERE path=?',
+                                     (os.path.abspath(path),))
+
+    def prune(self):
+        '''Forget entries for files that no longer exist.'''
+        with self._lock:
+            paths = [r[0] for r in self._db.execute('SELECT DISTINCT path FROM digests')]
+            gone = [(p,) for p in paths if not os.path.exists(p)]
+            with self._db:
+                self._db.executemany('DELETE FROM digests WHERE path=?', gone)
+        return len(gone)
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute('SELECT COUNT(*) FROM digests').fetchone()[0]
+
+    def _Evict(self):
+        # Caller holds the lock. Trim to 90% so we don't evict on every put
+        for table in ('digests', 'set_digests'):
+            n = self._db.execute('SELECT COUNT(*) FROM ' + table).fetchone()[0]
+            if n <= self.max_entries:
+                continue
+            keep = int(self.max_entries * 0.9)
+            with self._db:
+                self._db.execute('''DELETE FROM {0} WHERE rowid IN (
+                    SELECT rowid FROM {0} ORDER BY last_used ASC LIMIT ?)'''.format(table), (n - keep,))
+    pass
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Manage the local cache of input file digests")
+    parser.add_argument("--cache", default=None,
+                        help="Path to the cache database (default $SAJE_HASH_CACHE or ~/.azure/saje-hashes.sqlite)")
+    parser.add_argument("--clear", action="store_true",
+                        help="Remove all entries")
+    parser.add_argument("--prune", action="store_true",
+                        help="Remove entries for files that no longer exist")
+    parser.add_argument("paths", nargs="*",
+                        help="Remove entries for these files")
+    args = parser.parse_args()
+
+    hc = HashCache(args.cache)
+    if args.clear:
+        hc.invalidate()
+    if args.prune:
+        print('Pruned', hc.prune(), 'entries')
+    for p in args.paths:
+        hc.invalidate(p)
+    print(len(hc), 'entries in', hc.path)
@@ -0,0 +1,146 @@
+from __future__ import print_function, unicode_literals
+import os
+import mmap
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+
+# Supported file digest algorithms. SHA1 is a plain digest of the
+# whole file, as used for all input names before other algorithms
+# existed. BLAKE2b uses the tree mode of the algorithm over fixed size
+# leaves, so the leaves of one large file can be hashed on different
+# cores and the result does not depend on how many there are.
+SHA1 = 'sha1'
+BLAKE2B = 'blake2b'
+ALGORITHMS = (SHA1, BLAKE2B)
+
+LEAF_SIZE = 8 << 20
+BLAKE2B_DIGEST_SIZE = 20
+# Below this many bytes in total, a process pool costs more than it saves
+PARALLEL_THRESHOLD = 64 << 20
+
+def _Map(f, offset, length):
+    return mmap.mmap(f.fileno(), length, access=mmap.ACCESS_READ, offset=offset)
+
+def _Sha1(path):
+    hasher = hashlib.sha1()
+    size = os.path.getsize(path)
+    if size:
+        with open(path, 'rb') as f:
+            m = _Map(f, 0, size)
+            try:
+                hasher.update(m)
+            finally:
+                m.close()
+    return hasher.hexdigest()
+
+def Sha1Stream(prefix, paths):
+    '''SHA1 of prefix followed by the contents of each file in turn.
+    This is how input container names were made before per-file
+    digests, so it cannot be split across processes.
+    '''
+    hasher = hashlib.sha1(prefix)
+    for path in paths:
+        size = os.path.getsize(path)
+        if not size:
+            continue
+        with open(path, 'rb') as f:
+            m = _Map(f, 0, size)
+            try:
+                hasher.update(m)
+            finally:
+                m.close()
+    return hasher.hexdigest()
+
+def _Blake2bNode(depth, offset, last):
+    return hashlib.blake2b(digest_size=BLAKE2B_DIGEST_SIZE,
+                           fanout=0, depth=2, leaf_size=LEAF_SIZE,
+                           inner_size=BLAKE2B_DIGEST_SIZE,
+                           node_offset=offset, node_depth=depth,
+                           last_node=last)
+
+def _Blake2bLeaf(path, index, last):
+    node = _Blake2bNode(0, index, last)
+    offset = index * LEAF_SIZE
+    length = min(LEAF_SIZE, os.path.getsize(path) - offset)
+    if length > 0:
+        with open(path, 'rb') as f:
+            m = _Map(f, offset, length)
+            try:
+                node.update(m)
+            finally:
+                m.close()
+    return node.digest()
+
+def _Blake2bRoot(leaves):
+    root = _Blake2bNode(1, 0, True)
+    for leaf in leaves:
+        root.update(leaf)
+    return root.hexdigest()
+
+def _NumLeaves(size):
+    # An empty file still has one (empty) leaf
+    return max(1, (size + LEAF_SIZE - 1) // LEAF_SIZE)
+
+def FileDigest(path, algorithm=SHA1):
+    '''Digest of one file's contents, computed in this process.'''
+    if algorithm == SHA1:
+        return _Sha1(path)
+    if algorithm == BLAKE2B:
+        n = _NumLeaves(os.path.getsize(path))
+        return _Blake2bRoot(_Blake2bLeaf(path, i, i == n - 1) for i in range(n))
+    raise ValueError('Unknown digest algorithm "{}"'.format(algorithm))
+
+class ParallelHasher(object):
+    '''Compute digests of many files across a pool of processes.
+
+    SHA1 work is split per file; BLAKE2b work is split per leaf, so a
+    single huge file is spread over all workers too. Digests found in
+    the optional HashCache are not recomputed.
+    '''
+    def __init__(self, algorithm=SHA1, max_workers=None, cache=None):
+        if algorithm not in ALGORITHMS:
+            raise ValueError('Unknown digest algorithm "{}"'.format(algorithm))
+        self.algorithm = algorithm
+        self.max_workers = max_workers
+        self.cache = cache
+
+    def _Compute(self, paths):
+        total = sum(os.path.getsize(p) for p in paths)
+        if self.max_workers == 1 or total < PARALLEL_THRESHOLD:
+            return {p: FileDigest(p, self.algorithm) for p in paths}
+
+        with ProcessPoolExecutor(max_workers=self.max_workers) as pool:
+            if self.algorithm == SHA1:
+                futures = {p: pool.submit(_Sha1, p) for p in paths}
+                return {p: fut.result() for p, fut in futures.items()}
+
+            leaf_futures = {}
+            for p in paths:
+                n = _NumLeaves(os.path.getsize(p))
+                leaf_futures[p] = [pool.submit(_Blake2bLeaf, p, i, i == n - 1)
+                                   for i in range(n)]
+            return {p: _Blake2bRoot(fut.result() for fut in futs)
+                    for p, futs in leaf_futures.items()}
+
+    def digests(self, paths):
+        '''Return a dict mapping each path to its hex digest.'''
+        ans = {}
+        missing = []
+        keys = {}
+        for p in set(paths):
+            hit = self.cache.get(p, self.algorithm) if self.cache is not None else None
+            if hit is None:
+                missing.append(p)
+                if self.cache is not None:
+                    keys[p] = self.cache.FileKey(p)
+            else:
+                ans[p] = hit
+
+        computed = self._Compute(missing)
+        for p, digest in computed.items():
+            # Only cache if the file did not change while we read it
+            if self.cache is not None and self.cache.FileKey(p) == keys[p]:
+                self.cache.put(p, digest, self.algorithm, key=keys[p])
+        ans.update(computed)
+        return ans
+    pass
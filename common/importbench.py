@@ -0,0 +1,60 @@
+from __future__ import print_function, division
+import os
+import sys
+import subprocess
+
+# Command line entry points whose start up time we care about
+ENTRY_POINTS = ['job.create', 'job.submitted', 'job.prepare', 'job.spec',
+                'job.cleanup', 'pool.create', 'pool.delete', 'pool.warm',
+                'pool.staging', 'job.accounts']
+# Modules that should not be imported just by importing an entry point
+HEAVY_MODULES = ['azure', 'adal', 'msrestazure', 'jsonschema']
+
+PROBE = '''
+import sys, time
+t0 = time.time()
+import {module}
+dt = time.time() - t0
+heavy = [m for m in {heavy!r} if m in sys.modules]
+print('%f|%s' % (dt * 1000, ','.join(heavy)))
+'''
+
+def TimeImport(package, entry_point):
+    '''Import one entry point in a fresh interpreter. Returns the time
+    in ms and the list of heavy modules it pulled in.
+    '''
+    pkg_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    code = PROBE.format(module=package + '.' + entry_point, heavy=HEAVY_MODULES)
+    out = subprocess.check_output([sys.executable, '-c', code],
+                                  cwd=os.path.dirname(pkg_dir))
+    ms, heavy = out.decode().strip().split('|')
+    return float(ms), [h for h in heavy.split(',') if h]
+
+def Benchmark(repeat=5):
+    '''Return {entry_point: (median ms, heavy modules)}'''
+    package = os.path.basename(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    ans = {}
+    for ep in ENTRY_POINTS:
+        runs = [TimeImport(package, ep) for i in range(repeat)]
+        times = sorted(ms for ms, _ in runs)
+        ans[ep] = (times[len(times) // 2], runs[-1][1])
+    return ans
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Measure the cold import time of the command line entry points")
+    parser.add_argument("--repeat", "-r", default=5, type=int,
+                        help="Number of fresh interpreters per entry point")
+    parser.add_argument("--max-ms", default=None, type=float,
+                        help="Exit with an error if any entry point is slower than this")
+    args = parser.parse_args()
+
+    results = Benchmark(args.repeat)
+    failed = False
+    for ep, (ms, heavy) in sorted(results.items()):
+        note = ' (imports {})'.format(', '.join(heavy)) if heavy else ''
+        print('{:<16} {:8.1f} ms{}'.format(ep, ms, note))
+        if heavy or (args.max_ms is not None and ms > args.max_ms):
+            failed = True
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,62 @@
+from __future__ import print_function, unicode_literals
+import os
+import json
+import threading
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+class LockedJsonFile(object):
+    '''A small JSON file of private data shared between processes.
+
+    Readers and writers take an exclusive lock (within this process
+    and, where the platform allows, with others), and writes go via a
+    temporary file renamed into place, so the file is never torn. It
+    is only ever readable by its owner.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def locked(self):
+        with self._lock:
+            d = os.path.dirname(os.path.abspath(self.path))
+            if not os.path.isdir(d):
+                os.makedirs(d, 0o700)
+            if fcntl is None:
+                yield
+                return
+            fd = os.open(self.path + '.lock', os.O_RDWR | os.O_CREAT, 0o600)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                yield
+            finally:
+                os.close(fd)
+
+    def load(self):
+        '''Caller must hold the lock'''
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def save(self, data):
+        '''Caller must hold the lock'''
+        tmp = self.path + '.tmp'
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f, default=str)
+        # In case the file predates us with looser permissions
+        os.chmod(tmp, 0o600)
+        os.rename(tmp, self.path)
+
+    def remove(self):
+        '''Caller must hold the lock'''
+        if os.path.exists(self.path):
+            os.remove(self.path)
+    pass
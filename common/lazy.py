@@ -0,0 +1,26 @@
+import importlib
+
+class LazyModule(object):
+    '''Stand in for a module that is only imported when one of its
+    attributes is first used.
+
+    The Azure SDK packages are large and slow to import, so modules
+    that need them at call time but not at import time hold one of
+    these instead, keeping start up of the command line tools fast.
+    '''
+    def __init__(self, name):
+        self.__dict__['_name'] = name
+        self.__dict__['_module'] = None
+
+    def _Load(self):
+        if self._module is None:
+            self.__dict__['_module'] = importlib.import_module(self._name)
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self._Load(), attr)
+
+    def __repr__(self):
+        state = 'loaded' if self._module is not None else 'not loaded'
+        return '<lazy module {} ({})>'.format(self._name, state)
+    pass
@@ -89,7 +89,8 @@ class Converter(StatusReporter):
 
         if not container.exists('source.vhd'):
             self.info("Copying VHD")
-            self.src_vhd_url = container.copy('source.vhd', input_vhd_url)
+            self.src_vhd_url = container.copy('source.vhd', input_vhd_url,
+                                              verbosity=self.verbosity)
         else:
             self.info("Using existing copy of VHD")
             self.src_vhd_url = container.url('source.vhd')
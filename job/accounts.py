@@ -0,0 +1,174 @@
+from __future__ import print_function, unicode_literals
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+from ..az import batch
+from ..pool.vmsizes import VmSize
+from ..pool.warm import Name, WarmPool, WarmPoolManager
+from ..status import StatusReporter
+from .create import JobCreator
+
+class Capacity(object):
+    '''Room for nodes of one VM size in one Batch account: the most
+    idle nodes in any one pool a job could use now, and the nodes the
+    unused core quota could add.
+    '''
+    def __init__(self, helper, vm, quota, used_cores, idle_nodes):
+        self.helper = helper
+        self.vm = vm
+        self.quota = quota
+        self.used_cores = used_cores
+        self.idle_nodes = idle_nodes
+
+    @property
+    def free_nodes(self):
+        return max(0, self.quota - self.used_cores) // self.vm.cores
+
+    def fits(self, n_nodes):
+        return self.idle_nodes >= n_nodes or self.free_nodes >= n_nodes
+
+    def __repr__(self):
+        return '<Capacity {}/{} ({}): {} idle, {} more within quota>'.format(
+            self.helper.group, self.helper.name, self.helper.account.location,
+            self.idle_nodes, self.free_nodes)
+    pass
+
+class AccountSet(StatusReporter):
+    '''Several Batch accounts, possibly in different regions, used as
+    one.
+
+    Each new job is routed to the account with the most room for it,
+    preferring one with a warm pool that has enough idle nodes to start
+    at once, and otherwise the one with the most unused core quota,
+    per VM family where the account enforces that. The JobCreator it
+    gets uses that account's own auto-storage account, so the job's
+    input and output containers are in the region that runs it.
+
+    accounts is a list of dicts with "group" and "batch" keys and
+    optionally "image_id", since custom images belong to one region.
+    Only pools of that image count as idle capacity, as jobs are sent
+    to warm pools.
+    '''
+    pool_fields = (WarmPoolManager.pool_fields + ',currentDedicatedNodes,'
+                   'currentLowPriorityNodes,targetLowPriorityNodes')
+
+    def __init__(self, accounts, verbosity=1, max_workers=None):
+        self.verbosity = verbosity
+        self.accounts = accounts
+        self.max_workers = max_workers or len(accounts)
+        self.helpers = self._Map(lambda acc: batch.Helper(acc['group'], acc['batch'],
+                                                          verbosity=verbosity-1),
+                                 accounts)
+
+    @classmethod
+    def FromFile(cls, path, verbosity=1, max_workers=None):
+        '''Load the account list from a JSON file'''
+        with open(path) as f:
+            return cls(json.load(f), verbosity=verbosity, max_workers=max_workers)
+
+    def _Map(self, func, items):
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            return list(pool.map(func, items))
+
+    def _Quota(self, account, vm, low_priority):
+        '''Return the core quota the VM size counts against, and the
+        VM family it is for or None if it is for the whole account
+        '''
+        if low_priority:
+            return account.low_priority_core_quota, None
+        if getattr(account, 'dedicated_core_quota_per_vm_family_enforced', False):
+            for fam in account.dedicated_core_quota_per_vm_family or []:
+                if vm.family is not None and fam.name.lower() == vm.family.lower():
+                    return fam.core_quota, vm.family
+            self.debug('No family quota found for {}, using the account quota'.format(vm.name))
+        return account.dedicated_core_quota, None
+
+    def _Capacity(self, helper, image_id, vm, low_priority, app_packages, tasks_per_node):
+        quota, family = self._Quota(helper.account, vm, low_priority)
+        matcher = WarmPoolManager(helper.group, helper.name, image_id, vm.name,
+                                  app_packages=app_packages, verbosity=self.verbosity-1, helper=helper)
+        opts = batch.models.PoolListOptions(select=self.pool_fields)
+        node_opts = batch.models.ComputeNodeListOptions(select=WarmPoolManager.node_fields)
+        used = 0
+        idle = 0
+        for pool in helper.client.pool.list(pool_list_options=opts):
+            pool_vm = VmSize.Get(pool.vm_size)
+            if family is not None and (pool_vm.family or '').lower() != family.lower():
+                continue
+            if low_priority:
+                nodes = max(pool.current_low_priority_nodes or 0, pool.target_low_priority_nodes or 0)
+            else:
+                nodes = max(pool.current_dedicated_nodes or 0, pool.target_dedicated_nodes or 0)
+            used += nodes * pool_vm.cores
+            # Idle nodes only help if one pool JobCreator would use
+            # has enough of them
+            if image_id is None or Name(pool.state) != 'active' or pool.vm_size.lower() != vm.name.lower():
+                continue
+            wp = WarmPool(pool, list(helper.client.compute_node.list(
+                pool.id, compute_node_list_options=node_opts)), 0)
+            if wp.steady and matcher.matches(wp, tasks_per_node):
+                idle = max(idle, wp.free)
+        return Capacity(helper, vm, quota, used, idle)
+
+    def _ImageId(self, i, image_id):
+        return image_id if image_id is not None else self.accounts[i].get('image_id')
+
+    def capacity(self, vm_size='Standard_H16r', low_priority=False, image_id=None,
+                 app_packages=None, tasks_per_node=1):
+        '''Return the Capacity of every account, queried concurrently.
+        image_id, if given, is used instead of each account's own.
+        '''
+        vm = VmSize.Get(vm_size)
+        return self._Map(lambda i: self._Capacity(self.helpers[i], self._ImageId(i, image_id), vm,
+                                                  low_priority, app_packages, tasks_per_node),
+                         range(len(self.helpers)))
+
+    def choose(self, n_nodes, vm_size='Standard_H16r', low_priority=False, **kwargs):
+        '''Return the index of the account with most room for n_nodes.
+        Other arguments are passed on to capacity.
+        '''
+        caps = self.capacity(vm_size, low_priority, **kwargs)
+        for cap in caps:
+            self.debug(cap)
+        fits = [i for i, cap in enumerate(caps) if cap.fits(n_nodes)]
+        if not fits:
+            raise RuntimeError('No account has room for {} {} node(s)'.format(n_nodes, vm_size))
+        best = max(fits, key=lambda i: (caps[i].idle_nodes >= n_nodes,
+                                        caps[i].free_nodes + caps[i].idle_nodes))
+        self.info('Routing to', caps[best])
+        return best
+
+    def job_creator(self, n_nodes, vm_size='Standard_H16r', low_priority=False, **kwargs):
+        '''A JobCreator for the account with most room for n_nodes,
+        counting low-priority rather than dedicated quota if asked.
+        Other arguments are passed on to JobCreator.
+        '''
+        i = self.choose(n_nodes, vm_size, low_priority, image_id=kwargs.get('image_id'),
+                        app_packages=kwargs.get('app_packages'))
+        helper = self.helpers[i]
+        kwargs['image_id'] = self._ImageId(i, kwargs.get('image_id'))
+        kwargs.setdefault('verbosity', self.verbosity)
+        return JobCreator(helper.group, helper.name, vm_size=vm_size, helper=helper, **kwargs)
+    pass
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Show the free capacity of several Batch accounts")
+    parser.add_argument("--verbose", "-v", action="count", default=0,
+                        help="Increase the verbosity level - can be provided multiple times")
+    parser.add_argument("--quiet", "-q", action="count", default=0,
+                        help="Decrease the verbosity level")
+
+    parser.add_argument("--vm-size", default='Standard_H16r',
+                        help="VM size to count capacity in")
+    parser.add_argument("--low-priority", action="store_true",
+                        help="Count low-priority rather than dedicated capacity")
+    parser.add_argument("accounts",
+                        help="JSON file listing the accounts as {\"group\": ..., \"batch\": ...}")
+    args = parser.parse_args()
+    verbosity = args.verbose - args.quiet + 1
+
+    accounts = AccountSet.FromFile(args.accounts, verbosity=verbosity)
+    for cap in accounts.capacity(args.vm_size, args.low_priority):
+        print(cap)
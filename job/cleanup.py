@@ -0,0 +1,202 @@
+from __future__ import print_function, unicode_literals
+import re
+import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+from ..az import batch
+from ..status import StatusReporter
+from .prepare import InputStore
+from .create import JobCreator
+
+# Names of per-input-set containers made by InputPrepper.ComputeHash
+INPUT_CONTAINER_RE = re.compile('^([a-z0-9]+-)?[0-9a-f]{40}$')
+# Blob URLs in run scripts and input manifests
+BLOB_URL_RE = re.compile(r"https://[^/\s']+/([a-z0-9-]+)/([^?\s']+)")
+
+class GarbageCollector(StatusReporter):
+    '''Remove stale job output and input containers from a Batch
+    account's storage.
+
+    Retention rules:
+    - containers of jobs that Batch has not finished are always kept;
+    - anything younger than max_age_days is kept;
+    - input store manifests date from their last use, and the store
+      blobs a kept manifest uses are kept whatever their age;
+    - with keep_referenced, input containers and input store blobs
+      that are used by a kept job's run script are kept whatever their
+      age.
+
+    Containers that are neither Batch jobs, input containers nor the
+    input store are only touched if they hold a run script, or an index
+    of run scripts, i.e. are the output of a job that has since been
+    deleted from Batch.
+    '''
+    default_max_workers = 16
+    live_states = ('active', 'enabling', 'disabling', 'disabled', 'terminating')
+
+    def __init__(self, group_name, batch_name, max_age_days=30, keep_referenced=True,
+                 dry_run=False, max_workers=None, verbosity=1):
+        self.verbosity = verbosity
+        self.batch = batch.Helper(group_name, batch_name, verbosity=verbosity-1)
+        self.blob_service = self.batch.storage.block_blob_service
+        self.max_age = datetime.timedelta(days=max_age_days)
+        self.keep_referenced = keep_referenced
+        self.dry_run = dry_run
+        self.max_workers = max_workers or self.default_max_workers
+
+    def _Old(self, when):
+        if when is None:
+            return False
+        # The SDKs return timezone aware UTC times
+        now = datetime.datetime.now(when.tzinfo) if when.tzinfo else datetime.datetime.utcnow()
+        return now - when > self.max_age
+
+    @staticmethod
+    def _State(job):
+        return getattr(job.state, 'value', job.state)
+
+    def _References(self, container, blob_name):
+        '''Return the set of (container, blob) pairs named by URLs in
+        a script or manifest blob.
+        '''
+        try:
+            text = container.to_str(blob_name)
+        except Exception as e:
+            self.debug('Cannot read', container.name, blob_name, e)
+            return set()
+        return set(BLOB_URL_RE.findall(text))
+
+    def _Scripts(self, container):
+        '''Names of the run scripts in a job's output container: the
+        one at the top, or those listed in the script index for jobs
+        with one per task
+        '''
+        ans = []
+        if container.exists('run.sh'):
+            ans.append('run.sh')
+        if container.exists(JobCreator.script_index):
+            ans += container.to_str(JobCreator.script_index).split()
+        return ans
+
+    def _ScriptReferences(self, container, scripts):
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            found = list(pool.map(lambda name: self._References(container, name), scripts))
+        return set().union(*found)
+
+    def _Plan(self):
+        '''Work out what to delete. Returns (containers, store_blobs).'''
+        jobs = {job.id: job for job in self.batch.client.job.list()}
+        self.info('Found {} Batch job(s)'.format(len(jobs)))
+
+        outputs = []
+        inputs = []
+        store = None
+        for cont in self.blob_service.list_containers():
+            if cont.name == InputStore.container_name:
+                store = cont
+            elif cont.name in jobs:
+                outputs.append((cont, jobs[cont.name]))
+            elif INPUT_CONTAINER_RE.match(cont.name):
+                inputs.append(cont)
+            elif self._Scripts(cont):
+                outputs.append((cont, None))
+            else:
+                self.debug('Ignoring unrecognised container', cont.name)
+
+        doomed = []
+        referenced = set()
+        for cont, job in outputs:
+            if job is not None:
+                live = self._State(job) in self.live_states
+                when = job.state_transition_time or job.creation_time
+            else:
+                live = False
+                when = cont.properties.last_modified
+            if live or not self._Old(when):
+                self.debug('Keeping job container', cont.name)
+                if self.keep_referenced:
+                    referenced |= self._ScriptReferences(cont, self._Scripts(cont))
+            else:
+                doomed.append(cont)
+
+        referenced_conts = set(c for c, _ in referenced)
+        for cont in inputs:
+            if self.keep_referenced and cont.name in referenced_conts:
+                self.debug('Keeping referenced input container', cont.name)
+            elif self._Old(cont.properties.last_modified):
+                doomed.append(cont)
+
+        store_blobs = []
+        if store is not None:
+            blobs = list(store)
+            manifests = [b for b in blobs if b.name.startswith(InputStore.manifest_prefix)]
+            for b in manifests:
+                if self._Old(b.properties.last_modified):
+                    # A manifest promises its files exist, so it must go
+                    # if they might
+                    store_blobs.append(b.name)
+                else:
+                    referenced |= self._References(store, b.name)
+            for b in blobs:
+                if b.name.startswith(InputStore.manifest_prefix):
+                    continue
+                if (store.name, b.name) in referenced:
+                    continue
+                if self._Old(b.properties.last_modified):
+                    store_blobs.append(b.name)
+
+        return doomed, store_blobs
+
+    def __call__(self):
+        doomed, store_blobs = self._Plan()
+        self.info('{} container(s) and {} input store blob(s) to delete'.format(
+            len(doomed), len(store_blobs)))
+        for cont in doomed:
+            self.info('  container', cont.name)
+        for name in store_blobs:
+            self.debug('  blob', InputStore.container_name, name)
+        if self.dry_run:
+            self.info('Dry run: nothing deleted')
+            return doomed, store_blobs
+
+        store = self.blob_service.get_container(InputStore.container_name) if store_blobs else None
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            futures = [pool.submit(self.blob_service.delete_container, c.name) for c in doomed]
+            futures += [pool.submit(store.delete, name) for name in store_blobs]
+            for fut in futures:
+                fut.result()
+        self.info('Deleted')
+        return doomed, store_blobs
+    pass
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Delete stale job output and input containers")
+    parser.add_argument("--verbose", "-v", action="count", default=0,
+                        help="Increase the verbosity level - can be provided multiple times")
+    parser.add_argument("--quiet", "-q", action="count", default=0,
+                        help="Decrease the verbosity level")
+
+    parser.add_argument("--resource-group", "-g", required=True,
+                        help="Name of resource group containing the batch account (required)")
+    parser.add_argument("--batch-account", "-b", required=True,
+                        help="Name of the batch account (required)")
+    parser.add_argument("--max-age", "-a", default=30, type=float,
+                        help="Keep anything younger than this many days")
+    parser.add_argument("--ignore-references", action="store_true",
+                        help="Delete old inputs even if kept jobs still refer to them")
+    parser.add_argument("--workers", "-w", default=None, type=int,
+                        help="Number of concurrent deletes")
+    parser.add_argument("--dry-run", "-n", action="store_true",
+                        help="Only report what would be deleted")
+
+    args = parser.parse_args()
+    verbosity = args.verbose - args.quiet + 1
+
+    gc = GarbageCollector(args.resource_group, args.batch_account,
+                          max_age_days=args.max_age,
+                          keep_referenced=not args.ignore_references,
+                          dry_run=args.dry_run, max_workers=args.workers,
+                          verbosity=verbosity)
+    gc()
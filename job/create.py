@@ -1,46 +1,187 @@
 from __future__ import print_function
 import os.path
 import hashlib
+import json
 import uuid
-
-from azure.storage.blob.models import ContainerPermissions
+from concurrent.futures import ThreadPoolExecutor
 
 from .. import resources
 from ..az import batch
+from ..az.storage import blob_models
 
 from .spec import JobSpec
 from ..status import StatusReporter
 from .prepare import InputPrepper
 from .submitted import SubmittedJob
+from .packing import PackingScheduler
+from .launch import LaunchProfile
+from .pipeline import SubmitPipeline
+from ..pool.vmsizes import VmSize
+from ..pool.warm import WarmPoolManager
+from ..pool.staging import AppPackage
 
 class JobCreator(StatusReporter):
-    node_size = 16
     task_id = 'task'
-
-    def __init__(self, group_name, batch_name, verbosity=1):
+    # Most tasks Batch accepts in one add_collection call
+    max_tasks_per_request = 100
+    add_retries = 3
+    default_max_workers = 8
+    # Lists the run scripts of jobs with one per task, in their own
+    # directories, so GarbageCollector can find what they use
+    script_index = 'run-scripts.txt'
+    # Times Batch reruns a failed task on a pool that may have
+    # low-priority nodes, as losing a node can fail a task outright
+    preempt_retries = 2
+
+    def __init__(self, group_name, batch_name, verbosity=1, image_id=None,
+                 vm_size='Standard_H16r', idle_minutes=30, app_packages=None,
+                 launch_profile='mpi', helper=None):
+        '''With an image_id, jobs given no pool name run on a warm pool
+        of that image and VM size with the AppPackages given - see
+        WarmPoolManager.
+
+        Parallel commands are started as the LaunchProfile named by the
+        job spec, or launch_profile, lays them out on the pool's VM size.
+        '''
         self.verbosity = verbosity
-        self.batch = batch.Helper(group_name, batch_name, verbosity=verbosity-1)
+        self.launch_profile = LaunchProfile.Get(launch_profile)
+        if helper is None:
+            helper = batch.Helper(group_name, batch_name, verbosity=verbosity-1)
+        self.batch = helper
         self.input_prep = InputPrepper(self.batch.storage.block_blob_service, verbosity=verbosity-1)
+        self.warm_pools = None
+        if image_id is not None:
+            self.warm_pools = WarmPoolManager(group_name, batch_name, image_id, vm_size,
+                                              idle_minutes=idle_minutes,
+                                              app_packages=app_packages,
+                                              verbosity=verbosity-1, helper=self.batch)
+        # Step times of the last submission, see SubmitPipeline
+        self.timings = []
         return
 
-    def __call__(self, pool_name, requested_nodes, job_id, job_spec, input_command_str, cleanup_command=None):
-
+    @property
+    def sudoer(self):
+        return batch.models.UserIdentity(auto_user=batch.models.AutoUserSpecification(elevation_level='admin'))
+
+    def __call__(self, pool_name, requested_nodes, job_id, job_spec, input_command_str=None,
+                 cleanup_command=None):
+        '''Submit the job. Without input_command_str its inputs are
+        prepared with the InputPrepper. A job spec with a sweep is
+        passed on to submit_sweep.
+
+        Steps that do not need each other - preparing inputs, finding
+        the pool, creating the output container, uploading scripts and
+        adding the job - run at once on a SubmitPipeline. The time each
+        took is kept in self.timings.
+        '''
         job = JobSpec.FromJson(job_spec)
-        self.info('Job ID:', job_id)
-
-        pool, n_nodes = self._PoolSetup(pool_name, requested_nodes)
-
+        if job.sweep is not None:
+            return self.submit_sweep(pool_name, requested_nodes, job_id, job_spec,
+                                     input_command_str, cleanup_command)
+        with SubmitPipeline(max_workers=self.default_max_workers, verbosity=self.verbosity) as pipeline:
+            self.info('Job ID:', job_id)
+            inputs = input_command_str
+            if inputs is None:
+                inputs = pipeline.step('prepare inputs', self.input_prep, job.inputs)
+            if job.stages:
+                submit = self._SubmitStages
+            else:
+                submit = self._SubmitSingle
+            submitted = submit(pipeline, pool_name, requested_nodes, job_id, job, inputs, cleanup_command)
+        self.timings = pipeline.timings
+        pipeline.report()
+        return submitted
+
+    def _SubmitSingle(self, pipeline, pool_name, requested_nodes, job_id, job, inputs, cleanup_command):
+        '''Submit the whole job as one task'''
+        pool_setup = pipeline.step('pool lookup', self._PoolSetup, pool_name, requested_nodes)
+        output = pipeline.step('output container', self._OutputContainer, job_id)
+        coord = pipeline.step('coordination upload', lambda out: self._Coordination(out[0], out[1]), output)
+
+        def add_job(pool_setup):
+            pool, n_nodes = pool_setup
+            self.info('Submitting job')
+            # The coordination script is only needed once tasks run
+            job_prep_task, job_rel_task, _ = self._MultiInstance(n_nodes, None)
+            job_param = batch.models.JobAddParameter(id=job_id, pool_info=batch.models.PoolInformation(pool.id),
+                                                     display_name=job.name,
+                                                     job_preparation_task=job_prep_task,
+                                                     job_release_task=job_rel_task,
+                                                     uses_task_dependencies=True)
+            self.batch.client.job.add(job_param)
+        job_added = pipeline.step('job add', add_job, pool_setup)
+
+        def upload_run(pool_setup, output, input_command_str):
+            pool, n_nodes = pool_setup
+            out_cont, out_sas, out_cont_url = output
+            vm = VmSize.Get(pool.vm_size)
+            self.debug('Pool VM size:', vm)
+            run_script = self._RunScript(job_id, job, input_command_str, n_nodes, vm,
+                                         out_cont_url, out_sas)
+            self.info('Uploading run script')
+            run = 'run.sh'
+            out_cont.from_str(run, run_script)
+            return batch.models.ResourceFile(out_cont.url(run, sas_token=out_sas), run)
+        run_resource = pipeline.step('run script upload', upload_run, pool_setup, output, inputs)
+
+        def add_task(pool_setup, run_resource, coord_resource, _):
+            mpi = self._MultiInstance(pool_setup[1], coord_resource)[2]
+            task_param = batch.models.TaskAddParameter(id=self.task_id,
+                                                       resource_files=[run_resource],
+                                                       command_line='sudo -u _azbatch ./run.sh',
+                                                       multi_instance_settings=mpi,
+                                                       constraints=self._Constraints(pool_setup[0]),
+                                                       user_identity=self.sudoer)
+            self.batch.client.task.add(job_id, task_param)
+            self._Cleanup(job_id, cleanup_command, [self.task_id])
+            self._EndWhenDone(job_id, pool_setup[0])
+        done = pipeline.step('task add', add_task, pool_setup, run_resource, coord, job_added)
+
+        self._Finish(job_id, done, job_added)
+        return SubmittedJob(self.batch.group, self.batch.name, str(job_id), helper=self.batch)
+
+    def _Finish(self, job_id, done, job_added):
+        '''Wait for the last step of a submission. The job is added
+        before its scripts are ready, so if a step fails after that the
+        job is deleted rather than left without tasks.
+        '''
+        try:
+            done.result()
+        except Exception:
+            if job_added.exception() is None:
+                self.info('Submission failed, deleting job', job_id)
+                self.batch.client.job.delete(job_id)
+            raise
+
+    def _OutputContainer(self, job_id):
         job_output_container = str(job_id)
         self.info('Output container:', job_output_container)
         blob_service = self.batch.storage.block_blob_service
         out_cont = blob_service.create_container(job_output_container)
-        out_sas = out_cont.generate_sas(ContainerPermissions.WRITE | ContainerPermissions.READ)
+        # List lets checkpoints be found again on restart
+        out_sas = out_cont.generate_sas(blob_models.ContainerPermissions.WRITE |
+                                        blob_models.ContainerPermissions.READ |
+                                        blob_models.ContainerPermissions.LIST)
         out_cont_url = 'https://{}/{}'.format(blob_service.primary_endpoint, job_output_container)
-
+        return out_cont, out_sas, out_cont_url
+
+    def _Profile(self, job):
+        if job.launch is None:
+            return self.launch_profile
+        return LaunchProfile.Get(job.launch)
+
+    def _RunScript(self, job_id, job, input_command_str, n_nodes, vm,
+                   out_cont_url, out_sas, output_prefix='', shared=False, stage=None):
+        '''Render run_template.sh. stage is (name, depends_on, indices,
+        saved) for a task that runs one Stage of a job: the commands are
+        numbered by indices, their position in the whole job, files are
+        fetched from the stages depended on and, if saved, passed on.
+        '''
         self.debug('Processing job spec')
         exec_commands = []
-        for cmd in job.commands:
-            exec_commands += cmd.process(len(exec_commands))
+        for i, cmd in enumerate(job.commands):
+            index = len(exec_commands) if stage is None else stage[2][i]
+            exec_commands += cmd.process(index)
 
         output_commands = []
         for output_item in job.outputs:
@@ -51,82 +192,402 @@ class JobCreator(StatusReporter):
             run_script_template = f.read()
             pass
 
+        profile = self._Profile(job)
+        self.debug('Launch profile:', profile.name)
+        checkpoint_start = checkpoint_stop = ''
+        if job.checkpoint is not None:
+            checkpoint_prefix = output_prefix if stage is None else stage[0] + '/'
+            checkpoint_start, checkpoint_stop = job.checkpoint.process(out_cont_url, out_sas, checkpoint_prefix)
+        stage_fetch = stage_save = ''
+        if stage is not None:
+            name, depends_on, _, saved = stage
+            functions = ''
+            for script in ('blob.sh', 'stage.sh'):
+                with open(resources.get('batch', script)) as f:
+                    functions += f.read()
+            functions = functions.format(output_container_url=out_cont_url, output_sas=out_sas)
+            stage_fetch = '\n'.join([functions] + ['stage_fetch {} || exit 1'.format(dep) for dep in depends_on] +
+                                     ['touch .stage_stamp'])
+            if saved:
+                stage_save = 'stage_save {} || exit 1'.format(name)
         run_script = run_script_template.format(
             job_id=job_id,
             input=input_command_str,
             commands='\n'.join(exec_commands),
             output='\n'.join(output_commands),
-
-            num_nodes=n_nodes,
-            num_cores=self.node_size*n_nodes,
-            cores_per_node=self.node_size,
+            checkpoint_start=checkpoint_start,
+            checkpoint_stop=checkpoint_stop,
+            stage_fetch=stage_fetch,
+            stage_save=stage_save,
 
             output_container_url=out_cont_url,
-            output_sas=out_sas)
+            output_prefix=output_prefix,
+            output_sas=out_sas,
+            **profile.script_vars(vm, n_nodes, shared))
         self.debug(run_script)
-
-        self.info('Uploading run and coordination scripts')
-        run = 'run.sh'
-        run_url = out_cont.url(run, sas_token=out_sas)
-        out_cont.from_str(run, run_script)
-        run_resource = batch.models.ResourceFile(run_url, run)
-
-        coord = 'coordination.sh'
-        coord_path = resources.get('batch', coord)
-        coord_url = out_cont.url(coord, sas_token=out_sas)
-        out_cont.upload(coord_path, coord)
-        coord_resource = batch.models.ResourceFile(coord_url, coord)
+        return run_script
+
+    def submit_packed(self, pool_name, job_id, tasks, cleanup_command=None, tasks_per_node=None):
+        '''Submit many small tasks as one job, packed onto the task slots
+        of the pool's nodes by their cores - see PackingScheduler.
+
+        tasks is a list of (task_id, job_spec, input_command_str) and
+        every job spec must give its cores. The outputs of each task go
+        under task_id/ in the job's output container. Without a pool
+        name, a warm pool with tasks_per_node slots per node is used,
+        by default as many as the largest task allows.
+        '''
+        self.info('Job ID:', job_id)
+        specs = {}
+        for task_id, job_spec, input_command_str in tasks:
+            job = JobSpec.FromJson(job_spec)
+            if job.cores is None:
+                raise ValueError('Job spec for task {} must give its cores to be packed'.format(task_id))
+            specs[task_id] = (job, input_command_str)
+        items = [(task_id, job.cores) for task_id, (job, _) in specs.items()]
+
+        if pool_name is None and self.warm_pools is not None:
+            node_cores = VmSize.Get(self.warm_pools.vm_size).cores
+            tasks_per_node = tasks_per_node or max(1, node_cores // max(c for _, c in items))
+            wanted = PackingScheduler(node_cores, tasks_per_node)
+            requested_nodes = wanted.nodes_needed(wanted.pack(items))
+        else:
+            requested_nodes = 1
+        pool, _ = self._PoolSetup(pool_name, requested_nodes, tasks_per_node=tasks_per_node or 1)
+        vm = VmSize.Get(pool.vm_size)
+        scheduler = PackingScheduler(vm.cores, pool.max_tasks_per_node or 1)
+        bundles = scheduler.pack(items)
+        self.info('Packed {} task(s) into {} bundle(s) of up to {} cores, filling {} node(s)'.format(
+            len(specs), len(bundles), scheduler.slot_cores, scheduler.nodes_needed(bundles)))
+
+        out_cont, out_sas, out_cont_url = self._OutputContainer(job_id)
+        self._ScriptIndex(out_cont, ['{}/run.sh'.format(task_id) for task_id in specs])
+        self.info('Uploading run and bundle scripts')
+        task_params = []
+        for i, members in enumerate(bundles):
+            bundle_id = 'bundle-{:04d}'.format(i)
+            resource_files = []
+            for task_id in members:
+                job, input_command_str = specs[task_id]
+                run = '{}/run.sh'.format(task_id)
+                # Each member sees a node of just its own cores
+                slot = VmSize(vm.name, job.cores, 1, vm.rdma_fabric)
+                out_cont.from_str(run, self._RunScript(job_id, job, input_command_str, 1, slot,
+                                                       out_cont_url, out_sas,
+                                                       output_prefix=task_id + '/', shared=True))
+                resource_files.append(batch.models.ResourceFile(out_cont.url(run, sas_token=out_sas), run))
+            script = bundle_id + '.sh'
+            out_cont.from_str(script, PackingScheduler.BundleScript(bundle_id, members))
+            resource_files.append(batch.models.ResourceFile(out_cont.url(script, sas_token=out_sas), script))
+            # Integer IDs so the cleanup task can depend on a range
+            task_params.append(batch.models.TaskAddParameter(id=str(i),
+                                                             display_name=bundle_id,
+                                                             resource_files=resource_files,
+                                                             command_line='sudo -u _azbatch ./' + script,
+                                                             constraints=self._Constraints(pool),
+                                                             user_identity=self.sudoer))
 
         self.info('Submitting job')
-        sudoer =  batch.models.UserIdentity(auto_user=batch.models.AutoUserSpecification(elevation_level='admin'))
-        pool_info = batch.models.PoolInformation(pool_name)
+        job_param = batch.models.JobAddParameter(id=job_id, pool_info=batch.models.PoolInformation(pool.id),
+                                                 uses_task_dependencies=True)
+        self.batch.client.job.add(job_param)
+        self._AddTasks(job_id, task_params)
+        self._Cleanup(job_id, cleanup_command, [t.id for t in task_params])
+
+        self._EndWhenDone(job_id, pool)
+
+        return SubmittedJob(self.batch.group, self.batch.name, str(job_id), helper=self.batch)
+
+    def submit_sweep(self, pool_name, requested_nodes, job_id, job_spec, input_command_str=None,
+                     cleanup_command=None, max_workers=None):
+        '''Submit every point of the job spec's sweep as a task, each on
+        requested_nodes nodes, in one job - see Sweep.
+
+        The inputs of each point are prepared with the InputPrepper,
+        once for each distinct set, unless input_command_str is given
+        for all points to share. Run scripts are uploaded, and tasks
+        added in chunks of max_tasks_per_request, on max_workers
+        threads. The outputs of each point go under its own directory,
+        point-NNNNN/, in the job's output container, and sweep.json there
+        maps those directories to points. Tasks are numbered from 0.
+        '''
+        job = JobSpec.FromJson(job_spec)
+        if job.sweep is None:
+            raise ValueError('Job spec has no sweep')
+        if job.stages:
+            raise ValueError('Job spec cannot have both a sweep and stages')
+        self.info('Job ID:', job_id)
+        points = job.expand()
+        if not points:
+            raise ValueError('Sweep has no points')
+        self.info('Sweep of {} point(s)'.format(len(points)))
+        max_workers = max_workers or self.default_max_workers
 
-        if n_nodes == 1:
-            job_prep_task = None
-            job_rel_task = None
-            mpi = None
-        else:
-            job_prep_task = batch.models.JobPreparationTask(command_line='echo "Job prep required by API but not needed here"')
-            job_rel_task = batch.models.JobReleaseTask(command_line='sh ../../uncoordinate.sh',
-                                                       user_identity=sudoer)
-            mpi = batch.models.MultiInstanceSettings(number_of_instances=n_nodes,
-                                                     coordination_command_line="sh ../coordination.sh > coord_out.txt 2> coord_err.txt",
-                                                     common_resource_files=[coord_resource])
-            pass
+        pool, n_nodes = self._PoolSetup(pool_name, requested_nodes)
+        vm = VmSize.Get(pool.vm_size)
+        out_cont, out_sas, out_cont_url = self._OutputContainer(job_id)
+        inputs = self._SweepInputs([spec for _, spec in points], input_command_str)
+
+        self.info('Uploading run scripts')
+        coord_resource = self._Coordination(out_cont, out_sas) if n_nodes > 1 else None
+        job_prep_task, job_rel_task, mpi = self._MultiInstance(n_nodes, coord_resource)
+        # Integer task IDs so the cleanup task can depend on a range
+        task_ids = [str(i) for i in range(len(points))]
+        dirs = ['point-{:05d}'.format(i) for i in range(len(points))]
+        self._ScriptIndex(out_cont, ['{}/run.sh'.format(d) for d in dirs])
+
+        def prepare(i):
+            run = '{}/run.sh'.format(dirs[i])
+            out_cont.from_str(run, self._RunScript(job_id, points[i][1], inputs[i], n_nodes, vm,
+                                                   out_cont_url, out_sas,
+                                                   output_prefix=dirs[i] + '/'))
+            resource = batch.models.ResourceFile(out_cont.url(run, sas_token=out_sas), 'run.sh')
+            return batch.models.TaskAddParameter(id=task_ids[i],
+                                                 display_name=json.dumps(points[i][0], sort_keys=True)[:1024],
+                                                 resource_files=[resource],
+                                                 command_line='sudo -u _azbatch ./run.sh',
+                                                 multi_instance_settings=mpi,
+                                                 constraints=self._Constraints(pool),
+                                                 user_identity=self.sudoer)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            task_params = list(executor.map(prepare, range(len(points))))
+        out_cont.from_str('sweep.json', json.dumps(
+            {d: point for d, (point, _) in zip(dirs, points)}, indent=1, sort_keys=True))
 
-        job_param = batch.models.JobAddParameter(id=job_id, pool_info=pool_info,
+        self.info('Submitting job')
+        job_param = batch.models.JobAddParameter(id=job_id, pool_info=batch.models.PoolInformation(pool.id),
                                                  display_name=job.name,
                                                  job_preparation_task=job_prep_task,
                                                  job_release_task=job_rel_task,
                                                  uses_task_dependencies=True)
         self.batch.client.job.add(job_param)
-        task_param = batch.models.TaskAddParameter(id=self.task_id,
-                                                   resource_files=[run_resource],
-                                                   command_line='sudo -u _azbatch ./run.sh',
-                                                   multi_instance_settings=mpi,
-                                                   user_identity=sudoer)
-        self.batch.client.task.add(job_id, task_param)
-
-        if cleanup_command is not None:
-            cleanup_param = batch.models.TaskAddParameter(id='{task_id}_cleanup'.format(task_id=self.task_id),
-                                                          command_line=cleanup_command,
-                                                          depends_on=batch.models.TaskDependencies(task_ids=[self.task_id]))
-            self.batch.client.task.add(job_id, cleanup_param)
+        self._AddTasks(job_id, task_params, max_workers)
+        self._Cleanup(job_id, cleanup_command, task_ids)
+        self._EndWhenDone(job_id, pool)
+
+        return SubmittedJob(self.batch.group, self.batch.name, str(job_id), helper=self.batch)
+
+    def _SubmitStages(self, pipeline, pool_name, requested_nodes, job_id, job, inputs, cleanup_command):
+        '''Submit each Stage of the job as its own task, on its own
+        number of nodes, depending on the tasks of the stages it needs.
+        '''
+        stages = job.stage_order()
+        self.info('Stages:', ', '.join(st.name for st in stages))
+        biggest = max(st.nodes or 0 for st in stages)
+        pool_setup = pipeline.step('pool lookup', self._PoolSetup, pool_name,
+                                   max(requested_nodes, biggest) if requested_nodes else 0)
+        output = pipeline.step('output container', self._OutputContainer, job_id)
+        index = pipeline.step('script index', lambda out: self._ScriptIndex(
+            out[0], ['{}/run.sh'.format(st.name) for st in stages]), output)
+
+        def layout(pool_setup):
+            '''Return the nodes of stages that do not say, and the most
+            any stage uses
+            '''
+            n_nodes = pool_setup[1]
+            if biggest > n_nodes:
+                raise RuntimeError('A stage wants {} nodes but the pool has {}'.format(biggest, n_nodes))
+            default_nodes = requested_nodes or n_nodes
+            return default_nodes, max(st.nodes or default_nodes for st in stages)
+
+        def upload_coord(pool_setup, output):
+            if layout(pool_setup)[1] > 1:
+                return self._Coordination(output[0], output[1])
+        coord = pipeline.step('coordination upload', upload_coord, pool_setup, output)
+
+        def add_job(pool_setup):
+            pool = pool_setup[0]
+            self.info('Submitting job')
+            job_prep_task, job_rel_task, _ = self._MultiInstance(layout(pool_setup)[1], None)
+            # A failed stage ends the job, else the stages after it
+            # would wait for ever
+            job_param = batch.models.JobAddParameter(id=job_id, pool_info=batch.models.PoolInformation(pool.id),
+                                                     display_name=job.name,
+                                                     job_preparation_task=job_prep_task,
+                                                     job_release_task=job_rel_task,
+                                                     on_task_failure='performExitOptionsJobAction',
+                                                     uses_task_dependencies=True)
+            self.batch.client.job.add(job_param)
+        job_added = pipeline.step('job add', add_job, pool_setup)
+
+        # Each stage gets the files of every stage before it, not just
+        # those it depends on directly
+        ancestors = {}
+        for st in stages:
+            before = set(st.depends_on)
+            for dep in st.depends_on:
+                before |= set(ancestors[dep])
+            ancestors[st.name] = [s.name for s in stages if s.name in before]
+        needed = set(dep for st in stages for dep in ancestors[st.name])
+        position = dict((id(cmd), i) for i, cmd in enumerate(job.commands))
+
+        def upload_run(st, pool_setup, output, input_command_str):
+            nodes = st.nodes or layout(pool_setup)[0]
+            out_cont, out_sas, out_cont_url = output
+            vm = VmSize.Get(pool_setup[0].vm_size)
+            stage_job = job.for_stage(st, final=st.name not in needed)
+            indices = [position[id(cmd)] for cmd in stage_job.commands]
+            run = '{}/run.sh'.format(st.name)
+            out_cont.from_str(run, self._RunScript(job_id, stage_job, input_command_str, nodes, vm,
+                                                   out_cont_url, out_sas,
+                                                   stage=(st.name, ancestors[st.name], indices, st.name in needed)))
+            return batch.models.ResourceFile(out_cont.url(run, sas_token=out_sas), 'run.sh')
+        self.info('Uploading run scripts')
+        run_resources = [pipeline.step('run script ' + st.name, upload_run, st, pool_setup, output, inputs)
+                         for st in stages]
+
+        end_job = batch.models.ExitConditions(default=batch.models.ExitOptions(job_action='terminate'))
+
+        def add_tasks(pool_setup, coord_resource, _, __, *resources):
+            task_params = []
+            for st, resource in zip(stages, resources):
+                nodes = st.nodes or layout(pool_setup)[0]
+                depends_on = batch.models.TaskDependencies(task_ids=st.depends_on) if st.depends_on else None
+                self.debug('Stage {} on {} node(s) after {}'.format(st.name, nodes, st.depends_on or 'nothing'))
+                task_params.append(batch.models.TaskAddParameter(id=st.name,
+                                                                 resource_files=[resource],
+                                                                 command_line='sudo -u _azbatch ./run.sh',
+                                                                 multi_instance_settings=self._MultiInstance(nodes, coord_resource)[2],
+                                                                 depends_on=depends_on,
+                                                                 constraints=self._Constraints(pool_setup[0]),
+                                                                 exit_conditions=end_job,
+                                                                 user_identity=self.sudoer))
+            self._AddTasks(job_id, task_params)
+            self._Cleanup(job_id, cleanup_command, [st.name for st in stages])
+            self._EndWhenDone(job_id, pool_setup[0])
+        done = pipeline.step('task add', add_tasks, pool_setup, coord, job_added, index, *run_resources)
+
+        self._Finish(job_id, done, job_added)
+        return SubmittedJob(self.batch.group, self.batch.name, str(job_id), helper=self.batch)
+
+    def _SweepInputs(self, specs, input_command_str):
+        '''Input commands for each of the expanded job specs'''
+        keys = [json.dumps([i.ToJson() for i in spec.inputs], sort_keys=True) for spec in specs]
+        if input_command_str is not None:
+            if len(set(keys)) > 1:
+                raise ValueError('Sweep inputs vary between points so cannot share input commands')
+            return [input_command_str] * len(specs)
+        prepared = {}
+        for key, spec in zip(keys, specs):
+            if key not in prepared:
+                prepared[key] = self.input_prep(spec.inputs)
+        self.info('Prepared {} distinct input set(s)'.format(len(prepared)))
+        return [prepared[key] for key in keys]
+
+    def _Coordination(self, out_cont, out_sas):
+        coord = 'coordination.sh'
+        coord_path = resources.get('batch', coord)
+        coord_url = out_cont.url(coord, sas_token=out_sas)
+        out_cont.upload(coord_path, coord)
+        return batch.models.ResourceFile(coord_url, coord)
 
+    def _MultiInstance(self, n_nodes, coord_resource):
+        '''Return the job preparation and release tasks and the
+        multi-instance settings for tasks on n_nodes nodes
+        '''
+        if n_nodes == 1:
+            return None, None, None
+        job_prep_task = batch.models.JobPreparationTask(command_line='echo "Job prep required by API but not needed here"')
+        job_rel_task = batch.models.JobReleaseTask(command_line='sh ../../uncoordinate.sh',
+                                                   user_identity=self.sudoer)
+        mpi = batch.models.MultiInstanceSettings(number_of_instances=n_nodes,
+                                                 coordination_command_line="sh ../coordination.sh > coord_out.txt 2> coord_err.txt",
+                                                 common_resource_files=[coord_resource])
+        return job_prep_task, job_rel_task, mpi
+
+    def _AddChunk(self, job_id, chunk):
+        '''Add up to max_tasks_per_request tasks, retrying any the
+        service failed to add through its own error
+        '''
+        for attempt in range(self.add_retries):
+            result = self.batch.client.task.add_collection(job_id, chunk)
+            failed = [r for r in result.value if getattr(r.status, 'value', r.status).lower() != 'success']
+            if not failed:
+                return
+            client_errors = [r for r in failed if getattr(r.status, 'value', r.status).lower() == 'clienterror']
+            if client_errors:
+                err = client_errors[0]
+                raise RuntimeError('Adding task {} failed: {}'.format(
+                    err.task_id, err.error.message if err.error is not None else 'client error'))
+            retry = set(r.task_id for r in failed)
+            self.debug('Retrying {} task(s) after server errors'.format(len(retry)))
+            chunk = [t for t in chunk if t.id in retry]
+        raise RuntimeError('Could not add {} task(s) to job {}'.format(len(chunk), job_id))
+
+    def _AddTasks(self, job_id, task_params, max_workers=None):
+        chunks = [task_params[start:start + self.max_tasks_per_request]
+                  for start in range(0, len(task_params), self.max_tasks_per_request)]
+        self.debug('Adding {} task(s) in {} request(s)'.format(len(task_params), len(chunks)))
+        with ThreadPoolExecutor(max_workers=max_workers or self.default_max_workers) as executor:
+            for fut in [executor.submit(self._AddChunk, job_id, chunk) for chunk in chunks]:
+                fut.result()
+
+    def _ScriptIndex(self, out_cont, names):
+        '''Record the run scripts of a job before they are uploaded'''
+        out_cont.from_str(self.script_index, '\n'.join(names) + '\n')
+
+    @staticmethod
+    def _DependsOn(task_ids):
+        '''TaskDependencies on all of task_ids. Runs of integer IDs
+        become ranges, as Batch limits the size of the ID list.
+        '''
+        numbers = sorted(int(t) for t in task_ids if t.isdigit() and str(int(t)) == t)
+        others = [t for t in task_ids if not (t.isdigit() and str(int(t)) == t)]
+        ranges = []
+        for n in numbers:
+            if ranges and n == ranges[-1][1] + 1:
+                ranges[-1][1] = n
+            else:
+                ranges.append([n, n])
+        return batch.models.TaskDependencies(
+            task_ids=others or None,
+            task_id_ranges=[batch.models.TaskIdRange(start=a, end=b) for a, b in ranges] or None)
+
+    def _Cleanup(self, job_id, cleanup_command, task_ids):
+        if cleanup_command is None:
+            return
+        cleanup_param = batch.models.TaskAddParameter(id='{task_id}_cleanup'.format(task_id=self.task_id),
+                                                      command_line=cleanup_command,
+                                                      depends_on=self._DependsOn(task_ids))
+        self.batch.client.task.add(job_id, cleanup_param)
+
+    @staticmethod
+    def _LowPriority(pool):
+        return bool(pool.target_low_priority_nodes or pool.current_low_priority_nodes or
+                    '$TargetLowPriorityNodes' in (pool.auto_scale_formula or ''))
+
+    def _Constraints(self, pool):
+        '''Task constraints for the pool. Batch requeues a task whose
+        node is preempted while it runs, but not one that fails as a
+        result, such as an MPI task that lost a rank, so on pools that
+        may have low-priority nodes failed tasks are retried.
+        '''
+        if not self._LowPriority(pool):
+            return None
+        return batch.models.TaskConstraints(max_task_retry_count=self.preempt_retries)
+
+    def _EndWhenDone(self, job_id, pool):
         # Set the job to finish once the task is done
         self.batch.client.job.patch(job_id, batch.models.JobPatchParameter(on_all_tasks_complete='terminateJob'))
 
-        return SubmittedJob(self.batch.group, self.batch.name, str(job_id))
+    def _PoolSetup(self, pool_name, requested_nodes, tasks_per_node=1):
+        if pool_name is None:
+            if self.warm_pools is None:
+                raise ValueError('Need a pool name or an image ID to find a warm pool')
+            if requested_nodes < 1:
+                raise ValueError('Must request a number of nodes to use a warm pool')
+            pool_name = self.warm_pools.acquire(requested_nodes, tasks_per_node)
 
-    def _PoolSetup(self, pool_name, requested_nodes):
         self.info('Requesting {} node(s) from pool {}/{}'.format(requested_nodes if requested_nodes > 0 else 'all', self.batch.url, pool_name))
         pool = self.batch.client.pool.get(pool_name)
-        size = pool.current_dedicated_nodes
+        size = (pool.current_dedicated_nodes or 0) + (pool.current_low_priority_nodes or 0)
 
         n_nodes = requested_nodes if requested_nodes else size
 
         if n_nodes > size:
             raise RuntimeError('Requested more nodes that in the pool')
+        if n_nodes > 1 and tasks_per_node == 1 and (pool.max_tasks_per_node or 1) > 1:
+            raise RuntimeError('Multi-node tasks need a pool with one task per node')
 
         return pool, n_nodes
 
@@ -141,12 +602,24 @@ if __name__ == "__main__":
     parser.add_argument("--quiet", "-q", action="count", default=0,
                         help="Decrease the verbosity level")
 
-    parser.add_argument("--resource-group", "-g", required=True,
-                        help="Name of resource group containing the batch account (required)")
-    parser.add_argument("--batch-account", "-b", required=True,
-                        help="Name of the batch account containing the pool (required)")
-    parser.add_argument("--pool-name", "-p", required=True,
-                        help="Name of the pool (required)")
+    parser.add_argument("--resource-group", "-g", default=None,
+                        help="Name of resource group containing the batch account")
+    parser.add_argument("--batch-account", "-b", default=None,
+                        help="Name of the batch account containing the pool")
+    parser.add_argument("--accounts", default=None,
+                        help="JSON file of accounts to route the job to the one with most room, instead of -g and -b and -p")
+    parser.add_argument("--pool-name", "-p", default=None,
+                        help="Name of the pool - if omitted, pick or create a warm pool")
+    parser.add_argument("--image-id", "-i", default=None,
+                        help="Resource ID of the image for warm pools")
+    parser.add_argument("--vm-size", default='Standard_H16r',
+                        help="VM size for warm pools")
+    parser.add_argument("--idle-minutes", default=30, type=float,
+                        help="Delete warm pools idle for longer than this")
+    parser.add_argument("--app-package", action="append", default=[], metavar="ID[:VERSION]",
+                        help="Application package warm pools must have - can be repeated")
+    parser.add_argument("--launch-profile", default='mpi',
+                        help="How to lay out MPI ranks if the job spec does not say")
 
     parser.add_argument("--nodes", "-n", default=0, type=int,
                         help="Number of nodes to use - zero => whole pool")
@@ -157,6 +630,24 @@ if __name__ == "__main__":
     args = parser.parse_args()
     verbosity = args.verbose - args.quiet + 1
 
-    jc = JobCreator(args.resource_group, args.batch_account, verbosity=verbosity)
-
-    jc(args.pool_name, args.nodes, args.jobspec)
+    options = dict(verbosity=verbosity, idle_minutes=args.idle_minutes,
+                   app_packages=[AppPackage.Parse(p) for p in args.app_package],
+                   launch_profile=args.launch_profile)
+    if args.accounts is not None:
+        from .accounts import AccountSet
+        if args.pool_name is not None:
+            parser.error('--pool-name cannot be used with --accounts, which routes jobs to warm pools')
+        if args.image_id is not None:
+            options['image_id'] = args.image_id
+        accounts = AccountSet.FromFile(args.accounts, verbosity=verbosity)
+        jc = accounts.job_creator(args.nodes, args.vm_size, **options)
+    elif args.resource_group is None or args.batch_account is None:
+        parser.error('Need --accounts or both --resource-group and --batch-account')
+    else:
+        jc = JobCreator(args.resource_group, args.batch_account, image_id=args.image_id,
+                        vm_size=args.vm_size, **options)
+
+    with open(args.jobspec) as f:
+        job_spec = json.load(f)
+    # Inputs are prepared as part of the submission
+    jc(args.pool_name, args.nodes, str(uuid.uuid4()), job_spec)
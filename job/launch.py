@@ -0,0 +1,94 @@
+from __future__ import print_function, division, unicode_literals
+
+# Intel MPI settings for each fabric between nodes
+FABRIC_ENV = {
+    'shm': [('I_MPI_FABRICS', 'shm')],
+    'tcp': [('I_MPI_FABRICS', 'shm:tcp')],
+    'dapl': [('I_MPI_FABRICS', 'shm:dapl'),
+             ('I_MPI_DAPL_PROVIDER', 'ofa-v2-ib0'),
+             ('I_MPI_DYNAMIC_CONNECTION', '0')],
+    'ofa': [('I_MPI_FABRICS', 'shm:ofa')],
+    }
+
+class LaunchProfile(object):
+    '''How to lay out and start the MPI ranks of a parallel command on
+    a given VM size.
+
+    ranks is what each rank gets: a 'core', a 'numa' domain or the
+    whole 'node', with an OpenMP thread for each of its cores. With pin
+    the ranks, and their threads, are bound to their cores. fabric
+    forces an Intel MPI fabric; by default it is shared memory on one
+    node, else the VM's RDMA fabric if it has one and TCP if not.
+    '''
+    def __init__(self, name, ranks='core', pin=True, fabric=None):
+        if ranks not in ('core', 'numa', 'node'):
+            raise ValueError('Ranks must be per core, numa or node, not ' + ranks)
+        if fabric is not None and fabric not in FABRIC_ENV:
+            raise ValueError('Unknown fabric ' + fabric)
+        self.name = name
+        self.ranks = ranks
+        self.pin = pin
+        self.fabric = fabric
+
+    @classmethod
+    def Get(cls, name):
+        try:
+            return PROFILES[name]
+        except KeyError:
+            raise ValueError('Unknown launch profile {}, choose from {}'.format(
+                name, ', '.join(sorted(PROFILES))))
+
+    def layout(self, vm):
+        '''Return (ranks per node, threads per rank)'''
+        if self.ranks == 'core':
+            return vm.cores, 1
+        if self.ranks == 'numa':
+            return vm.numa_nodes, vm.cores_per_numa
+        return 1, vm.cores
+
+    def Fabric(self, vm, n_nodes):
+        if self.fabric is not None:
+            return self.fabric
+        if n_nodes == 1:
+            return 'shm'
+        return vm.rdma_fabric or 'tcp'
+
+    def env(self, vm, n_nodes, shared=False):
+        '''Environment for the run script, as (name, value) pairs. A
+        shared node has other tasks on it, so nothing is pinned.
+        '''
+        ranks_per_node, threads = self.layout(vm)
+        ans = [('MPI_ROOT', '$I_MPI_ROOT')]
+        ans += FABRIC_ENV[self.Fabric(vm, n_nodes)]
+        pin = self.pin and not shared
+        ans.append(('I_MPI_PIN', '1' if pin else '0'))
+        if pin:
+            ans.append(('I_MPI_PIN_DOMAIN', 'core' if threads == 1 else 'omp'))
+        ans.append(('OMP_NUM_THREADS', str(threads)))
+        if pin and threads > 1:
+            ans += [('OMP_PROC_BIND', 'close'), ('OMP_PLACES', 'cores')]
+        return ans
+
+    def script_vars(self, vm, n_nodes, shared=False):
+        '''The values run_template.sh needs to start MPI'''
+        ranks_per_node, threads = self.layout(vm)
+        return dict(num_nodes=n_nodes,
+                    num_cores=vm.cores * n_nodes,
+                    cores_per_node=vm.cores,
+                    ranks_per_node=ranks_per_node,
+                    num_ranks=ranks_per_node * n_nodes,
+                    threads_per_rank=threads,
+                    launch_env='\n'.join('export {}={}'.format(k, v)
+                                         for k, v in self.env(vm, n_nodes, shared)))
+    pass
+
+PROFILES = {p.name: p for p in [
+    # One pinned rank per core, what HemeLB wants
+    LaunchProfile('mpi'),
+    LaunchProfile('mpi-unpinned', pin=False),
+    # A rank per NUMA domain or node with OpenMP threads on its cores
+    LaunchProfile('hybrid-numa', ranks='numa'),
+    LaunchProfile('hybrid-node', ranks='node'),
+    # Ignore any RDMA network
+    LaunchProfile('mpi-tcp', fabric='tcp'),
+    ]}
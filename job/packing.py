@@ -0,0 +1,67 @@
+from __future__ import print_function, division
+
+# Runs the members of a bundle side by side, each in its own directory,
+# and fails if any of them does
+BUNDLE_TEMPLATE = '''#!/usr/bin/env bash
+# Bundle {bundle_id}
+pids=""
+{launches}
+status=0
+for pid in $pids; do
+    wait $pid || status=1
+done
+exit $status
+'''
+LAUNCH_COMMAND = '(cd {task_id} && ./run.sh > run.out 2> run.err) & pids="$pids $!"'
+
+class PackingScheduler(object):
+    '''Place tasks that need only a few cores onto the task slots of a
+    pool.
+
+    A pool runs up to tasks_per_node tasks at once on each node but
+    Batch does not know how many cores they use, so each slot is given
+    node_cores // tasks_per_node cores. Tasks are packed into bundles
+    whose cores add up to at most that, largest first into the first
+    bundle with room, and each bundle is submitted as a single Batch
+    task that runs its members side by side.
+    '''
+    def __init__(self, node_cores, tasks_per_node):
+        if tasks_per_node < 1 or node_cores < tasks_per_node:
+            raise ValueError('Cannot split {} cores into {} slots'.format(node_cores, tasks_per_node))
+        self.node_cores = node_cores
+        self.tasks_per_node = tasks_per_node
+
+    @property
+    def slot_cores(self):
+        return self.node_cores // self.tasks_per_node
+
+    def pack(self, items):
+        '''Pack (key, cores) pairs. Returns a list of bundles, each a
+        list of keys.
+        '''
+        bundles = []
+        free = []
+        for key, cores in sorted(items, key=lambda item: -item[1]):
+            if cores > self.slot_cores:
+                raise ValueError('{} needs {} cores but a slot has only {}'.format(
+                    key, cores, self.slot_cores))
+            for i, room in enumerate(free):
+                if cores <= room:
+                    bundles[i].append(key)
+                    free[i] -= cores
+                    break
+            else:
+                bundles.append([key])
+                free.append(self.slot_cores - cores)
+        return bundles
+
+    def nodes_needed(self, bundles):
+        '''Nodes to run all the bundles at once'''
+        return -(-len(bundles) // self.tasks_per_node)
+
+    @staticmethod
+    def BundleScript(bundle_id, task_ids):
+        return BUNDLE_TEMPLATE.format(
+            bundle_id=bundle_id,
+            launches='\n'.join(LAUNCH_COMMAND.format(task_id=t) for t in task_ids))
+    pass
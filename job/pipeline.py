@@ -0,0 +1,56 @@
+from __future__ import print_function, division
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from ..status import StatusReporter
+
+def _Resolve(value):
+    return value.result() if isinstance(value, Future) else value
+
+class SubmitPipeline(StatusReporter):
+    '''Run the steps of a job submission on threads, each as soon as the
+    steps it needs are done, and time them.
+
+    A step's arguments may be the Futures of earlier steps, which it
+    waits for and is called with the results of. Steps must be added
+    after the steps they wait for: the executor starts them in order,
+    so a waiting step never holds a thread a step it needs could use.
+
+    timings is a list of (name, start, duration), in seconds from the
+    creation of the pipeline, not counting the wait for other steps.
+    '''
+    def __init__(self, max_workers=8, verbosity=1):
+        self.verbosity = verbosity
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.timings = []
+        self.t0 = time.time()
+        self.elapsed = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.executor.shutdown(wait=True)
+        self.elapsed = time.time() - self.t0
+        return False
+
+    def step(self, name, func, *args, **kwargs):
+        '''Call func when its arguments are ready and return its Future'''
+        def run():
+            real_args = [_Resolve(a) for a in args]
+            real_kwargs = dict((k, _Resolve(v)) for k, v in kwargs.items())
+            start = time.time()
+            try:
+                return func(*real_args, **real_kwargs)
+            finally:
+                self.timings.append((name, start - self.t0, time.time() - start))
+        return self.executor.submit(run)
+
+    def report(self):
+        '''Print the end-to-end time and, when debugging, each step's'''
+        elapsed = self.elapsed if self.elapsed is not None else time.time() - self.t0
+        work = sum(dt for _, _, dt in self.timings)
+        self.info('Submitted in {:.2f} s, running {:.2f} s of steps side by side'.format(elapsed, work))
+        for name, start, dt in sorted(self.timings, key=lambda t: t[1]):
+            self.debug('  {:<24} {:7.2f} s from {:7.2f} s'.format(name, dt, start))
+    pass
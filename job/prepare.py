@@ -1,73 +1,248 @@
 from __future__ import print_function, unicode_literals
-import os.path
+import os
+import binascii
 import hashlib
+import tarfile
+import tempfile
 
-from azure.storage.blob.models import ContainerPermissions
 
 from .spec import ReproducibleHash    
+from ..common.hashcache import HashCache
+from ..common.hashing import ParallelHasher, Sha1Stream, SHA1
 from ..status import StatusReporter
 from ..az import batch
+from ..az.storage import blob_models
+
+FETCH_COMMAND = "curl '{url}?{{input_container_sas}}' > {path}\n"
+UNPACK_COMMAND = "curl -sf '{url}?{{input_container_sas}}' | tar -xz\n"
+
+def InputPaths(input_spec, sort=True):
+    """List the local paths of all input files, in order, with each
+    pattern's matches sorted unless not sort
+    """
+    paths = []
+    for input_item in input_spec:
+        paths += input_item.apply(lambda path: path, sort=sort)
+    return paths
+
+def IsPacked(input_item):
+    return getattr(input_item, 'pack', False)
+
+def PackInputs(paths):
+    """Stream the files into a gzipped tar archive in a temporary file
+    and return its path. Members keep the paths as given, so extracting
+    in the task directory puts them where unpacked inputs would go.
+    """
+    fd, archive = tempfile.mkstemp(suffix='.tar.gz')
+    with os.fdopen(fd, 'wb') as raw:
+        with tarfile.open(fileobj=raw, mode='w:gz') as tar:
+            for path in paths:
+                info = tar.gettarinfo(path, arcname=path)
+                info.uid = info.gid = 0
+                info.uname = info.gname = ''
+                with open(path, 'rb') as f:
+                    tar.addfile(info, f)
+    return archive
+
+class InputStore(StatusReporter):
+    """Content addressed store of input files shared by all jobs.
+
+    Every file is kept once in a single container as a blob named by
+    the digest of its contents, so unchanged files are never uploaded
+    twice no matter which job uses them. The input of a job is a small
+    manifest blob holding the commands to fetch its files from the
+    store, named after the digest of the input spec and file digests.
+
+    Files are stored under a prefix naming the digest algorithm, so
+    changing algorithm never confuses one digest for another.
+    """
+    container_name = 'saje-input-store'
+    manifest_prefix = 'manifests/'
+    pack_prefix = 'packs/'
+
+    def __init__(self, blob_service, block_size=None, max_workers=None, hash_cache=None,
+                 algorithm=SHA1, hash_workers=None, verbosity=1):
+        self.verbosity = verbosity
+        self.blob_service = blob_service
+        self.block_size = block_size
+        self.max_workers = max_workers
+        self.hasher = ParallelHasher(algorithm, max_workers=hash_workers, cache=hash_cache)
+        self.file_prefix = algorithm + '/'
+        self.container = blob_service.create_container(self.container_name)
+
+    def Digests(self, input_spec):
+        """Return a list of (path, digest) for every input file"""
+        paths = InputPaths(input_spec)
+        digests = self.hasher.digests(paths)
+        return [(path, digests[path]) for path in paths]
+
+    def ManifestName(self, input_spec, digests):
+        hashable = {'algorithm': self.hasher.algorithm,
+                    'spec': [i.ToJson() for i in input_spec],
+                    'files': [[path, digest] for path, digest in digests]}
+        if self.hasher.algorithm == SHA1:
+            # Manifests written before the algorithm was selectable
+            del hashable['algorithm']
+        return binascii.hexlify(ReproducibleHash(hashable)).decode()
+
+    def __call__(self, input_spec):
+        digests = self.Digests(input_spec)
+        manifest = self.manifest_prefix + self.ManifestName(input_spec, digests)
+        self.info('Input manifest:', manifest)
+        in_sas = self.container.generate_sas(blob_models.ContainerPermissions.READ)
+
+        if self.container.exists(manifest):
+            self.debug('Using existing input manifest')
+            # So the garbage collector dates it from its last use
+            self.container.touch(manifest)
+            return self.container.to_str(manifest).format(input_container_sas=in_sas)
+
+        digest_map = dict(digests)
+        to_upload = {}
+        archives = []
+        input_commands = []
+        try:
+            for input_item in input_spec:
+                paths = input_item.apply(lambda path: path)
+                if IsPacked(input_item):
+                    # Packs are named by their members' paths and digests
+                    # so they need not be built to find out if they exist
+                    members = [[path, digest_map[path]] for path in paths]
+                    blob_name = '{}{}.tar.gz'.format(
+                        self.pack_prefix, binascii.hexlify(ReproducibleHash(members)).decode())
+                    if blob_name not in to_upload and not self.container.exists(blob_name):
+                        self.debug('Packing {} file(s) into {}'.format(len(paths), blob_name))
+                        archive = PackInputs(paths)
+                        archives.append(archive)
+                        to_upload[blob_name] = archive
+                    input_commands.append(UNPACK_COMMAND.format(url=self.container.url(blob_name)))
+                    continue
+
+                for path in paths:
+                    blob_name = self.file_prefix + digest_map[path]
+                    if blob_name not in to_upload and not self.container.exists(blob_name):
+                        to_upload[blob_name] = path
+                    input_commands.append(FETCH_COMMAND.format(url=self.container.url(blob_name),
+                                                               path=path))
+
+            self.info('Uploading {} blob(s) not already in store'.format(len(to_upload)))
+            if to_upload:
+                self.container.upload_many([(path, blob_name) for blob_name, path in to_upload.items()],
+                                           block_size=self.block_size,
+                                           max_workers=self.max_workers,
+                                           verbosity=self.verbosity)
+        finally:
+            for archive in archives:
+                os.remove(archive)
+
+        input_command_str = '\n'.join(input_commands)
+        # Written last so that a manifest only exists once all its
+        # files are in the store
+        self.container.from_str(manifest, input_command_str)
+        return input_command_str.format(input_container_sas=in_sas)
+    pass
 
 class InputPrepper(StatusReporter):
-    def __init__(self, blob_service, verbosity=1):
+    def __init__(self, blob_service, block_size=None, max_workers=None, use_store=True,
+                 hash_cache=None, algorithm=SHA1, hash_workers=None, verbosity=1):
         self.verbosity = verbosity
         self.blob_service = blob_service
+        self.block_size = block_size
+        self.max_workers = max_workers
+        self.use_store = use_store
+        if hash_cache is None:
+            hash_cache = HashCache()
+        self.hash_cache = hash_cache
+        self.algorithm = algorithm
+        self.hash_workers = hash_workers
         return
     
     @staticmethod
-    def ComputeHash(input_spec):
+    def ComputeHash(input_spec, cache=None, algorithm=SHA1, hash_workers=None):
         """Generate a unique name that depends on the input
+
+        Names from the SHA1 algorithm are the SHA1 of the input spec
+        followed by the bytes of every file, as they always have been,
+        so existing input containers are found again. The cache keeps
+        that digest for as long as none of the files changes. Names
+        from other algorithms combine per-file digests, so the files
+        can be hashed in parallel, and are prefixed with the
+        algorithm's name.
         """
         hashable = [i.ToJson() for i in input_spec]
         # Start with the SHA1 of the input specification
         in_spec_hash = ReproducibleHash(hashable)
 
-        # Now update with the hashes of the actual input files
+        if algorithm == SHA1:
+            # In glob order, as the files always were
+            paths = InputPaths(input_spec, sort=False)
+            compute = lambda: Sha1Stream(in_spec_hash, paths)
+            if cache is None:
+                return compute()
+            return cache.set_digest(in_spec_hash, paths, compute)
+
+        # Now update with the digests of the actual input files, which
+        # can come from the cache without reading the files
+        paths = InputPaths(input_spec)
         hasher = hashlib.sha1(in_spec_hash)
-        def filehash(path):
-            BLOCKSIZE = 2 << 15
-            with open(path, 'rb') as afile:
-                buf = afile.read(BLOCKSIZE)
-                while len(buf) > 0:
-                    hasher.update(buf)
-                    buf = afile.read(BLOCKSIZE)
-                    
-        for input_item in input_spec:
-            input_item.apply(filehash)
-        return hasher.hexdigest()
+        digests = ParallelHasher(algorithm, max_workers=hash_workers, cache=cache).digests(paths)
+        for path in paths:
+            hasher.update(digests[path].encode())
+        return '{}-{}'.format(algorithm, hasher.hexdigest())
     
     def ReadContainer(self, job_input_container):
         self.debug('Getting input commands from existing container')
         in_cont = self.blob_service.get_container(job_input_container)
         input_command_str = in_cont.to_str(job_input_container)
-        in_sas = in_cont.generate_sas(ContainerPermissions.READ)
+        in_sas = in_cont.generate_sas(blob_models.ContainerPermissions.READ)
         return input_command_str.format(input_container_sas=in_sas)
     
     def CreateContainer(self, job_input_container, input_spec):
         self.debug('Creating input container')
         in_cont = self.blob_service.create_container(job_input_container, fail_on_exist=True)
         
-        def upld(path):
-            base = os.path.basename(path)
-            url = in_cont.url(base)
-            self.debug('Uploading {} -> {}'.format(path, url))
-            in_cont.upload(path)
-            return "curl '{}?{{input_container_sas}}' > {}\n".format(url, path)
-        
-        input_commands = []
-        for input_item in input_spec:
-            input_commands += input_item.apply(upld)
+        uploads = []
+        archives = []
+        try:
+            for index, input_item in enumerate(input_spec):
+                paths = input_item.apply(lambda path: path)
+                if IsPacked(input_item):
+                    archive = PackInputs(paths)
+                    archives.append(archive)
+                    uploads.append((archive, 'pack-{}.tar.gz'.format(index), None))
+                else:
+                    uploads += [(path, os.path.basename(path), path) for path in paths]
+
+            self.info('Uploading {} input blob(s)'.format(len(uploads)))
+            urls = in_cont.upload_many([(path, blob_name) for path, blob_name, _ in uploads],
+                                       block_size=self.block_size,
+                                       max_workers=self.max_workers,
+                                       verbosity=self.verbosity)
+        finally:
+            for archive in archives:
+                os.remove(archive)
+
+        input_commands = [FETCH_COMMAND.format(url=url, path=dest) if dest is not None
+                          else UNPACK_COMMAND.format(url=url)
+                          for (_, _, dest), url in zip(uploads, urls)]
         input_command_str = '\n'.join(input_commands)
         
         # Azure metadata is sent in HTTP heads so escaping it is a
         # nightmare. Just store in a blob with same name at the container
         in_cont.from_str(job_input_container, input_command_str)
-        in_sas = in_cont.generate_sas(ContainerPermissions.READ)
+        in_sas = in_cont.generate_sas(blob_models.ContainerPermissions.READ)
         return input_command_str.format(input_container_sas=in_sas)
     
     def __call__(self, input_spec):
+        if self.use_store:
+            store = InputStore(self.blob_service, block_size=self.block_size,
+                               max_workers=self.max_workers, hash_cache=self.hash_cache,
+                               algorithm=self.algorithm, hash_workers=self.hash_workers,
+                               verbosity=self.verbosity)
+            return store(input_spec)
+
         # Input name is the digest
-        job_input_container = self.ComputeHash(input_spec)
+        job_input_container = self.ComputeHash(input_spec, self.hash_cache, self.algorithm, self.hash_workers)
         self.info('Input container:', job_input_container)
         
         if self.blob_service.exists(job_input_container):
@@ -77,10 +252,10 @@ class InputPrepper(StatusReporter):
             pass
         
     def ReadOnly(self, input_spec):
-        job_input_container = self.ComputeHash(input_spec)
+        job_input_container = self.ComputeHash(input_spec, self.hash_cache, self.algorithm, self.hash_workers)
         assert self.blob_service.exists(job_input_container)
         input_command_str = self.ReadContainer(job_input_container)
-        in_sas = in_cont.generate_sas(ContainerPermissions.READ)
+        in_sas = in_cont.generate_sas(blob_models.ContainerPermissions.READ)
         return input_command_str.format(input_container_sas=in_sas)
     pass
 
@@ -1,11 +1,16 @@
 from __future__ import print_function, unicode_literals
 import json
-import jsonschema
 import glob
+import itertools
+import copy
+import re
 import hashlib
 import six
 
 from .. import resources
+from ..common.lazy import LazyModule
+
+jsonschema = LazyModule('jsonschema')
 
 class Input(object):
     _subtypes = None
@@ -33,7 +38,7 @@ class InputFile(Input):
         ans.path = data['path']
         return ans
 
-    def apply(self, func):
+    def apply(self, func, sort=True):
         return [func(self.path)]
 
     def ToJson(self):
@@ -49,14 +54,24 @@ class InputPattern(Input):
     def FromJson(cls, data):
         ans = cls()
         ans.pattern = data['pattern']
+        # Send all matches as one compressed archive
+        ans.pack = data.get('pack', False)
         return ans
 
-    def apply(self, func):
-        return [func(f_path)for f_path in glob.iglob(self.pattern)]
+    def apply(self, func, sort=True):
+        # Sorted so names built from the matches do not depend on
+        # directory order; the SHA1 input container name predates that
+        # and hashes the matches in the order glob gives them
+        paths = glob.iglob(self.pattern)
+        if sort:
+            paths = sorted(paths)
+        return [func(f_path)for f_path in paths]
     
     def ToJson(self):
         ans = super(InputPattern, self).ToJson()
         ans['pattern'] = self.pattern
+        if self.pack:
+            ans['pack'] = True
         return ans
 
     pass
@@ -76,6 +91,8 @@ class Command(object):
         child_cls = cls._subtypes[type_str]
         ans = child_cls.FromJson(data)
         ans.redirect = data.get('redirect', False)
+        # Name of the Stage to run in, if the job has stages
+        ans.stage = data.get('stage')
         return ans
 
     def suffix(self, index):
@@ -92,8 +109,11 @@ class Command(object):
         return cmds
     
     def ToJson(self):
-        return {'type': self.TAG,
-                'redirect': self.redirect}
+        ans = {'type': self.TAG,
+               'redirect': self.redirect}
+        if self.stage is not None:
+            ans['stage'] = self.stage
+        return ans
     pass
 
 class SerialCommand(Command):
@@ -113,7 +133,8 @@ class SerialCommand(Command):
 
 class ParallelCommand(Command):
     TAG = 'parallel'
-    PREFIX = 'mpirun -np $num_cores -ppn $cores_per_node -hosts $AZ_BATCH_HOST_LIST '
+    # The layout comes from the job's LaunchProfile via run_template.sh
+    PREFIX = 'mpirun -np $num_ranks -ppn $ranks_per_node -hosts $AZ_BATCH_HOST_LIST '
     @classmethod
     def FromJson(cls, data):
         ans = cls()
@@ -182,10 +203,125 @@ class OutputPattern(Output):
     
     pass
 
+class Checkpoint(object):
+    '''A directory the commands write restart files to. While they run
+    it is copied to the output container every interval seconds, and
+    it is restored from there before they start, so a task that is
+    requeued after its node was preempted resumes from the last copy.
+    '''
+    REMOTE = '.checkpoint/'
+    STOP = ('kill $ckpt_pid\n'
+            'ckpt_save || { echo "Could not save checkpoint" >&2; exit 1; }')
+
+    @classmethod
+    def FromJson(cls, data):
+        ans = cls()
+        ans.path = data['path']
+        ans.interval = data.get('interval', 300)
+        return ans
+
+    def process(self, output_container_url, output_sas, output_prefix=''):
+        '''Return the script lines to go before and after the commands'''
+        with open(resources.get('batch', 'blob.sh')) as f:
+            template = f.read()
+        with open(resources.get('batch', 'checkpoint.sh')) as f:
+            template += f.read()
+        start = template.format(path=self.path.rstrip('/'), interval=self.interval,
+                                remote=output_prefix + self.REMOTE,
+                                output_container_url=output_container_url,
+                                output_sas=output_sas)
+        return start, self.STOP
+
+    def ToJson(self):
+        return {'path': self.path,
+                'interval': self.interval}
+    pass
+
+class Sweep(object):
+    '''A parameter study: the job is run once for every point.
+
+    The points are every combination of the values in parameters, a
+    dict of name to list of values, followed by any explicit points
+    given, each a dict of name to value. In the expressions, inputs
+    and outputs of the job, {{name}} stands for the value of the
+    parameter name at the point being run.
+    '''
+    PLACEHOLDER = re.compile(r'\{\{\s*(\w+)\s*\}\}')
+
+    @classmethod
+    def FromJson(cls, data):
+        ans = cls()
+        ans.parameters = data.get('parameters', {})
+        ans.explicit = data.get('points', [])
+        return ans
+
+    def points(self):
+        names = sorted(self.parameters)
+        ans = [dict(zip(names, values))
+               for values in itertools.product(*(self.parameters[n] for n in names))] if names else []
+        return ans + [dict(p) for p in self.explicit]
+
+    @classmethod
+    def Substitute(cls, jsObj, point):
+        '''Copy of jsObj with the placeholders in its strings filled in'''
+        if isinstance(jsObj, dict):
+            return {k: cls.Substitute(v, point) for k, v in jsObj.items()}
+        elif isinstance(jsObj, list):
+            return [cls.Substitute(v, point) for v in jsObj]
+        elif isinstance(jsObj, six.string_types):
+            def fill(m):
+                if m.group(1) not in point:
+                    raise KeyError('No sweep parameter {} for {}'.format(m.group(1), jsObj))
+                return str(point[m.group(1)])
+            return cls.PLACEHOLDER.sub(fill, jsObj)
+        return jsObj
+
+    def ToJson(self):
+        ans = {}
+        if self.parameters:
+            ans['parameters'] = self.parameters
+        if self.explicit:
+            ans['points'] = self.explicit
+        return ans
+    pass
+
+class Stage(object):
+    '''A group of the job's commands that runs as its own Batch task,
+    on nodes nodes (by default as many as the job asks for), once the
+    stages it depends_on have succeeded. Files a stage makes are passed
+    on to the stages that depend on it.
+    '''
+    NAME_RE = re.compile(r'^[A-Za-z0-9_-]{1,64}$')
+
+    @classmethod
+    def FromJson(cls, name, data):
+        if not cls.NAME_RE.match(name):
+            raise ValueError('Stage name {} is not a valid task ID'.format(name))
+        ans = cls()
+        ans.name = name
+        ans.nodes = data.get('nodes')
+        ans.depends_on = data.get('depends_on', [])
+        return ans
+
+    def ToJson(self):
+        ans = {}
+        if self.nodes is not None:
+            ans['nodes'] = self.nodes
+        if self.depends_on:
+            ans['depends_on'] = self.depends_on
+        return ans
+    pass
+
 class JobSpec(object):
-    with open(resources.get('batch', 'job_spec.json')) as sf:
-        schema = json.load(sf)
-    del sf
+    _schema = None
+
+    @classmethod
+    def Schema(cls):
+        """The JSON schema, only read from disk when first needed"""
+        if cls._schema is None:
+            with open(resources.get('batch', 'job_spec.json')) as sf:
+                JobSpec._schema = json.load(sf)
+        return cls._schema
 
     @classmethod
     def FromJson(cls, data):
@@ -194,13 +330,20 @@ class JobSpec(object):
         ans.inputs = [Input.FromJson(i) for i in data['inputs']]
         ans.commands = [Command.FromJson(c) for c in data['commands']]        
         ans.outputs = [Output.FromJson(o) for o in data['outputs']]
+        # Cores needed, if less than whole nodes, so it can share a node
+        ans.cores = data.get('cores')
+        # Name of the LaunchProfile, if not the default
+        ans.launch = data.get('launch')
+        ans.checkpoint = Checkpoint.FromJson(data['checkpoint']) if 'checkpoint' in data else None
+        ans.sweep = Sweep.FromJson(data['sweep']) if 'sweep' in data else None
+        ans.stages = {name: Stage.FromJson(name, st) for name, st in data.get('stages', {}).items()}
         return ans
     
     @classmethod
     def open(cls, filename):
         with open(filename) as f:
             js = json.load(f)
-        jsonschema.validate(js, cls.schema)
+        jsonschema.validate(js, cls.Schema())
                 
         return cls.FromJson(js)
 
@@ -210,8 +353,65 @@ class JobSpec(object):
         ans['inputs'] = [i.ToJson() for i in self.inputs]
         ans['commands'] = [c.ToJson() for c in self.commands]
         ans['outputs'] = [o.ToJson() for o in self.outputs]
-        jsonschema.validate(ans, self.schema)
+        if self.cores is not None:
+            ans['cores'] = self.cores
+        if self.launch is not None:
+            ans['launch'] = self.launch
+        if self.checkpoint is not None:
+            ans['checkpoint'] = self.checkpoint.ToJson()
+        if self.sweep is not None:
+            ans['sweep'] = self.sweep.ToJson()
+        if self.stages:
+            ans['stages'] = {name: st.ToJson() for name, st in self.stages.items()}
+        jsonschema.validate(ans, self.Schema())
         return ans        
+
+    def stage_order(self):
+        '''Return the stages with every stage after those it depends
+        on. Raises ValueError for unknown stages or cycles.
+        '''
+        for cmd in self.commands:
+            if cmd.stage not in self.stages:
+                raise ValueError('Command "{}" must be in one of the stages {}'.format(
+                    cmd.expression, ', '.join(sorted(self.stages))))
+        ans = []
+        done = set()
+        visiting = set()
+        def visit(name, path):
+            if name in done:
+                return
+            if name in visiting:
+                raise ValueError('Stage dependencies form a cycle: ' + ' -> '.join(path + [name]))
+            if name not in self.stages:
+                raise ValueError('Unknown stage {} in dependencies of {}'.format(name, path[-1]))
+            visiting.add(name)
+            for dep in self.stages[name].depends_on:
+                visit(dep, path + [name])
+            visiting.discard(name)
+            done.add(name)
+            ans.append(self.stages[name])
+        for name in sorted(self.stages):
+            visit(name, [])
+        return ans
+
+    def for_stage(self, stage, final):
+        '''A copy of this spec with just the commands of the stage, and
+        the outputs if it is a final stage, that no other depends on.
+        '''
+        ans = copy.copy(self)
+        ans.commands = [cmd for cmd in self.commands if cmd.stage == stage.name]
+        ans.outputs = self.outputs if final else []
+        ans.stages = {}
+        return ans
+
+    def expand(self):
+        '''Return a (point, JobSpec) pair for each point of the sweep,
+        the JobSpec having that point's values filled in.
+        '''
+        data = self.ToJson()
+        del data['sweep']
+        return [(point, JobSpec.FromJson(Sweep.Substitute(data, point)))
+                for point in self.sweep.points()]
     pass
 
 def ReproducibleHash(jsObj):
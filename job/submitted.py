@@ -1,50 +1,211 @@
 from __future__ import print_function, unicode_literals
 import os.path
+import json
 import time
 
 #import azure.batch as batch
 
 from ..az import batch
+from ..az.transfer import Downloader, DownloadManifest
 from ..status import StatusReporter
-from ..common.cd import cd
+from .spec import Checkpoint
+
+def Name(state):
+    return getattr(state, 'value', state)
 
 class SubmittedJob(StatusReporter):
-    def __init__(self, group_name, batch_name, job_id, verbosity=1):
+    task_fields = 'id,state,executionInfo,nodeInfo,multiInstanceSettings'
+    # Restart files of checkpointed tasks and files passed between
+    # stages, not outputs
+    internal_markers = ('/' + Checkpoint.REMOTE, '/.stages/')
+    requeue_metadata = 'saje-requeues'
+
+    def __init__(self, group_name, batch_name, job_id, verbosity=1, helper=None):
         self.verbosity = verbosity
-        self.batch = batch.Helper(group_name, batch_name, verbosity=verbosity-1)
+        if helper is None:
+            helper = batch.Helper(group_name, batch_name, verbosity=verbosity-1)
+        self.batch = helper
         self.job_id = job_id
 
-    def wait_for_completion(self, timeout_s=3600):
+    def wait_for_completion(self, timeout_s=3600, requeue=False, max_requeues=3):
+        '''Wait for the job to complete. With requeue, tasks that failed
+        because they lost their node to preemption, even after Batch's
+        own retries, are requeued up to max_requeues times each while
+        the job is still running - see requeue_preempted.
+        '''
         t0 = time.time()
         tMax = t0 + timeout_s
         while self.get_state() != batch.models.JobState.completed:
+            if requeue:
+                self.requeue_preempted(max_requeues)
             if time.time() > tMax:
                 self.critical("Timed out!")
-                raise RunTimeError("Job checking timed out")
+                raise RuntimeError("Job checking timed out")
             
             self.debug("Job not complete")
             time.sleep(10)
 
+    def _Tasks(self):
+        opts = batch.models.TaskListOptions(select=self.task_fields)
+        return list(self.batch.client.task.list(self.job_id, task_list_options=opts))
+
+    @staticmethod
+    def _Failed(task):
+        info = task.execution_info
+        if info is None:
+            return False
+        result = getattr(info, 'result', None)
+        if result is not None:
+            return Name(result) == 'failure'
+        return info.exit_code != 0
+
+    def _NodeInfos(self, task):
+        ans = [task.node_info] if task.node_info is not None else []
+        if task.multi_instance_settings is not None:
+            ans += [sub.node_info for sub in self.batch.client.task.list_subtasks(self.job_id, task.id).value or []
+                    if sub.node_info is not None]
+        return ans
+
+    @staticmethod
+    def _NodeGone(err):
+        error = getattr(err, 'error', None)
+        return getattr(error, 'code', None) == 'NodeNotFound'
+
+    def _Preempted(self, task):
+        '''Whether any node the task ran on was preempted'''
+        opts = batch.models.ComputeNodeGetOptions(select='id,state')
+        for info in self._NodeInfos(task):
+            try:
+                node = self.batch.client.compute_node.get(info.pool_id, info.node_id,
+                                                          compute_node_get_options=opts)
+            except batch.models.BatchErrorException as e:
+                if not self._NodeGone(e):
+                    raise
+                # Preempted low-priority nodes may leave the pool
+                return True
+            if Name(node.state) == 'preempted':
+                return True
+        return False
+
+    def _Requeues(self):
+        '''Requeue counts by task ID, kept in the job's metadata so they
+        last from one process to the next
+        '''
+        opts = batch.models.JobGetOptions(select='metadata')
+        job = self.batch.client.job.get(self.job_id, job_get_options=opts)
+        items = job.metadata or []
+        for item in items:
+            if item.name == self.requeue_metadata:
+                return json.loads(item.value), items
+        return {}, items
+
+    def _SaveRequeues(self, counts, items):
+        items = [item for item in items if item.name != self.requeue_metadata]
+        items.append(batch.models.MetadataItem(name=self.requeue_metadata, value=json.dumps(counts)))
+        self.batch.client.job.patch(self.job_id, batch.models.JobPatchParameter(metadata=items))
+
+    def requeue_preempted(self, max_requeues=3):
+        '''Reactivate tasks that failed because a node they ran on was
+        preempted. Batch itself requeues a task whose node is preempted
+        while it runs, but not one that fails as a result, e.g. an MPI
+        task that lost one of its ranks, once its retries are used up.
+        Returns the IDs requeued.
+        '''
+        ans = []
+        counts = items = None
+        for task in self._Tasks():
+            if task.execution_info is not None and task.execution_info.requeue_count:
+                self.debug('Task {} requeued {} time(s) by Batch'.format(
+                    task.id, task.execution_info.requeue_count))
+            if Name(task.state) != 'completed' or not self._Failed(task):
+                continue
+            if not self._Preempted(task):
+                continue
+            if counts is None:
+                counts, items = self._Requeues()
+            n = counts.get(task.id, 0)
+            if n >= max_requeues:
+                self.critical('Task {} preempted {} times, not requeueing'.format(task.id, n))
+                continue
+            self.info('Task {} lost a node to preemption, requeueing'.format(task.id))
+            counts[task.id] = n + 1
+            # Counted first so a crash cannot requeue without limit
+            self._SaveRequeues(counts, items)
+            self.batch.client.task.reactivate(self.job_id, task.id)
+            ans.append(task.id)
+        return ans
+
     def get_state(self):
         job_info = self.batch.client.job.get(self.job_id)
         return job_info.state
 
 
-    def fetch_output(self, output_path):
+    def output_items(self, output_path):
+        '''List Downloader work items to fetch this job's output
+        container under output_path, tracked by a manifest there.
+        '''
         assert self.get_state() ==  batch.models.JobState.completed
-        
-        output_path = os.path.abspath(output_path)
-        if not os.path.exists(output_path):
-            os.makedirs(output_path)
 
+        output_path = os.path.abspath(output_path)
+        manifest = DownloadManifest(output_path)
         blob_service = self.batch.storage.block_blob_service
         out_cont = blob_service.get_container(self.job_id)
-        with cd(output_path):
-            for blb in out_cont.list():
-                # Make any necessary containing directories
-                out_dir = os.path.dirname(blb)
-                if out_dir != '' and not os.path.exists(out_dir):
-                    os.makedirs(out_dir)
-                out_cont.download(blb, blb)
+        return [(out_cont, blb, os.path.join(output_path, blb.name), manifest)
+                for blb in out_cont if not self._Internal(blb.name)]
+
+    def _Internal(self, blob_name):
+        return any(m in '/' + blob_name for m in self.internal_markers)
+
+    def fetch_output(self, output_path, max_workers=None, verify=False):
+        '''Download the job's outputs. Rerunning only fetches blobs
+        that are missing, partial or changed; verify=True also re-hashes
+        files already present.
+        '''
+        items = self.output_items(output_path)
+        self.info('Fetching {} blob(s) to {}'.format(len(items), output_path))
+        Downloader(max_workers=max_workers, verify=verify,
+                   verbosity=self.verbosity).download_many(items)
         return
     pass
+
+def FetchOutputs(group_name, batch_name, job_ids, output_path, max_workers=None, verify=False, verbosity=1):
+    '''Download the outputs of several completed jobs in one go, each
+    into output_path/job_id, sharing one Batch helper and one pool of
+    download workers.
+    '''
+    helper = batch.Helper(group_name, batch_name, verbosity=verbosity-1)
+    items = []
+    for job_id in job_ids:
+        job = SubmittedJob(group_name, batch_name, job_id, verbosity=verbosity, helper=helper)
+        items += job.output_items(os.path.join(output_path, job_id))
+    return Downloader(max_workers=max_workers, verify=verify,
+                      verbosity=verbosity).download_many(items)
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Download the outputs of completed jobs")
+    parser.add_argument("--verbose", "-v", action="count", default=0,
+                        help="Increase the verbosity level - can be provided multiple times")
+    parser.add_argument("--quiet", "-q", action="count", default=0,
+                        help="Decrease the verbosity level")
+
+    parser.add_argument("--resource-group", "-g", required=True,
+                        help="Name of resource group containing the batch account (required)")
+    parser.add_argument("--batch-account", "-b", required=True,
+                        help="Name of the batch account that ran the jobs (required)")
+    parser.add_argument("--output", "-o", default=".",
+                        help="Directory to put outputs in, one subdirectory per job")
+    parser.add_argument("--workers", "-w", default=None, type=int,
+                        help="Number of concurrent downloads")
+    parser.add_argument("--verify", action="store_true",
+                        help="Re-hash previously downloaded files against the manifest")
+
+    parser.add_argument("job_ids", nargs="+",
+                        help="IDs of the jobs to fetch")
+
+    args = parser.parse_args()
+    verbosity = args.verbose - args.quiet + 1
+
+    FetchOutputs(args.resource_group, args.batch_account, args.job_ids, args.output,
+                 max_workers=args.workers, verify=args.verify, verbosity=verbosity)
@@ -0,0 +1,144 @@
+from __future__ import print_function, division, unicode_literals
+import math
+import datetime
+
+class AutoScalePolicy(object):
+    '''Size a pool to the node requirement of its pending tasks.
+
+    Every pending task is taken to need nodes_per_task nodes (the
+    number_of_instances of our multi-instance tasks). The target is
+    the larger of the latest and the window-average pending demand,
+    clamped to [min_nodes, max_nodes]. Growth is immediate, but the
+    pool never shrinks below the peak demand seen over the last
+    cooldown minutes, so it does not release nodes that the next job
+    in a batch of submissions will want straight back.
+
+    With low_priority the policy sizes the pool's low-priority nodes
+    rather than its dedicated ones.
+
+    The same rules are available as a Batch autoscale formula, to
+    apply to a pool, and as a Python simulation, to try them offline
+    against recorded samples of the pending task count.
+    '''
+    # Batch will not evaluate more often than every 5 minutes
+    min_interval = 5
+
+    def __init__(self, min_nodes=0, max_nodes=1, nodes_per_task=1, window=5, cooldown=15,
+                 interval=5, low_priority=False):
+        self.min_nodes = min_nodes
+        self.max_nodes = max_nodes
+        self.nodes_per_task = nodes_per_task
+        self.window = window
+        self.cooldown = cooldown
+        self.interval = interval
+        self.low_priority = low_priority
+        self.validate()
+
+    def validate(self):
+        if not 0 <= self.min_nodes <= self.max_nodes:
+            raise ValueError('Need 0 <= min_nodes <= max_nodes, got {} and {}'.format(
+                self.min_nodes, self.max_nodes))
+        if self.nodes_per_task < 1:
+            raise ValueError('nodes_per_task must be at least 1')
+        if self.interval < self.min_interval:
+            raise ValueError('Evaluation interval must be at least {} minutes'.format(self.min_interval))
+        if self.window < 1 or self.cooldown < 0:
+            raise ValueError('Window must be positive and cooldown not negative')
+
+    @property
+    def evaluation_interval(self):
+        return datetime.timedelta(minutes=self.interval)
+
+    def formula(self):
+        '''The Batch autoscale formula implementing this policy'''
+        lines = [
+            '$window = TimeInterval_Minute * {window};',
+            '$cooldown = TimeInterval_Minute * {cooldown};',
+            # Use what we have now if the metrics are too patchy
+            '$ok = $PendingTasks.GetSamplePercent($window) >= 70;',
+            '$latest = $PendingTasks.GetSample(1);',
+            '$demand = $ok ? max($latest, avg($PendingTasks.GetSample($window))) * {nodes_per_task} '
+            ': $CurrentDedicatedNodes;',
+            '$wanted = min({max_nodes}, max({min_nodes}, ceil($demand)));',
+            '$peak = $ok ? max($PendingTasks.GetSample($cooldown)) * {nodes_per_task} '
+            ': $CurrentDedicatedNodes;',
+            '$floor = min($CurrentDedicatedNodes, min({max_nodes}, ceil($peak)));',
+            '$TargetDedicatedNodes = $wanted >= $CurrentDedicatedNodes ? $wanted : max($wanted, $floor);',
+            '$NodeDeallocationOption = taskcompletion;',
+            ]
+        # Batch requires a cooldown window of at least one sample
+        cooldown = max(self.cooldown, 1)
+        formula = '\n'.join(lines).format(window=self.window, cooldown=cooldown,
+                                          nodes_per_task=self.nodes_per_task,
+                                          min_nodes=self.min_nodes, max_nodes=self.max_nodes)
+        if self.low_priority:
+            formula = formula.replace('DedicatedNodes', 'LowPriorityNodes')
+        return formula
+
+    def target(self, samples, now, current):
+        '''Evaluate the policy at minute now, given (minute, pending
+        task count) samples and the current node count.
+        '''
+        def window(minutes):
+            return [n for t, n in samples if now - minutes < t <= now]
+        recent = window(self.window)
+        if not recent:
+            return current
+        latest = recent[-1]
+        demand = max(latest, sum(recent) / len(recent)) * self.nodes_per_task
+        wanted = min(self.max_nodes, max(self.min_nodes, int(math.ceil(demand))))
+        if wanted >= current:
+            return wanted
+        # No samples in the cooldown window means no recent demand
+        peak = max(window(max(self.cooldown, 1)) or [0]) * self.nodes_per_task
+        return max(wanted, min(current, self.max_nodes, int(math.ceil(peak))))
+
+    def simulate(self, samples, start_nodes=0):
+        '''Replay recorded samples, evaluating every interval minutes
+        and assuming the pool reaches each target at once. Returns a
+        list of (minute, target nodes).
+        '''
+        samples = sorted(samples)
+        if not samples:
+            return []
+        ans = []
+        current = start_nodes
+        now = samples[0][0]
+        end = samples[-1][0]
+        while now <= end:
+            current = self.target(samples, now, current)
+            ans.append((now, current))
+            now += self.interval
+        return ans
+    pass
+
+if __name__ == "__main__":
+    import argparse
+    import json
+
+    parser = argparse.ArgumentParser(description="Print an autoscale formula and replay recorded load against it")
+    parser.add_argument("--min-nodes", default=0, type=int)
+    parser.add_argument("--max-nodes", required=True, type=int)
+    parser.add_argument("--nodes-per-task", default=1, type=int,
+                        help="Nodes needed by each (multi-instance) task")
+    parser.add_argument("--window", default=5, type=int,
+                        help="Minutes of samples to average demand over")
+    parser.add_argument("--cooldown", default=15, type=int,
+                        help="Minutes of low demand before the pool shrinks")
+    parser.add_argument("--interval", default=5, type=int,
+                        help="Minutes between evaluations")
+    parser.add_argument("--low-priority", action="store_true",
+                        help="Scale low-priority rather than dedicated nodes")
+    parser.add_argument("--samples", default=None,
+                        help="JSON file of [minute, pending tasks] pairs to simulate")
+    args = parser.parse_args()
+
+    policy = AutoScalePolicy(args.min_nodes, args.max_nodes, args.nodes_per_task,
+                             args.window, args.cooldown, args.interval, args.low_priority)
+    print(policy.formula())
+    if args.samples:
+        with open(args.samples) as f:
+            samples = [tuple(s) for s in json.load(f)]
+        print()
+        for minute, nodes in policy.simulate(samples):
+            print('{:6.0f} min: {} node(s)'.format(minute, nodes))
@@ -4,36 +4,101 @@ import os
 from ..az import batch
 
 from ..status import StatusReporter
+from .autoscale import AutoScalePolicy
+from .staging import AppPackage, Dataset, PoolStaging
 
-class PoolStartWaiter(object):
-    def __init__(self, client, pool_id, user_params=None):
+class PoolStartError(RuntimeError):
+    pass
+
+class PoolStartWaiter(StatusReporter):
+    '''Wait for the nodes of a new pool to become usable.
+
+    Each poll fetches only the pool fields and node id/state that are
+    needed, using OData $select. The interval grows from min_poll to
+    max_poll while nothing changes and drops back when the node state
+    histogram moves. Nodes whose start task failed or that are
+    unusable end the wait at once with a PoolStartError.
+
+    With min_fraction < 1, waiting ends as soon as that fraction of the
+    target nodes are idle.
+    '''
+    min_poll = 2.0
+    max_poll = 30.0
+    backoff = 1.5
+    pool_fields = 'id,allocationState,targetDedicatedNodes,targetLowPriorityNodes,resizeErrors'
+    node_fields = 'id,state'
+
+    def __init__(self, client, pool_id, user_params=None, min_fraction=1.0, verbosity=1):
+        self.verbosity = verbosity
         self.client = client
         self.pool_id = pool_id
         self.target_states = set((batch.models.ComputeNodeState.idle,))
+        self.failed_states = set((batch.models.ComputeNodeState.start_task_failed,
+                                  batch.models.ComputeNodeState.unusable))
         self.user_params = user_params
+        self.min_fraction = min_fraction
+        self.histogram = {}
+        self.changed = False
         return
 
+    @staticmethod
+    def _Name(state):
+        return getattr(state, 'value', state)
+
+    def _Nodes(self, state_filter=None):
+        opts = batch.models.ComputeNodeListOptions(select=self.node_fields, filter=state_filter)
+        return list(self.client.compute_node.list(self.pool_id, compute_node_list_options=opts))
+
     def test(self):
-        p = self.client.pool.get(self.pool_id)
+        p = self.client.pool.get(self.pool_id,
+                                 pool_get_options=batch.models.PoolGetOptions(select=self.pool_fields))
         if p.resize_errors is not None:
             raise RuntimeError('resize error encountered for pool {}:\n{}'.format(p.id, p.resize_errors[0]))
-        nodes = list(self.client.compute_node.list(p.id))
-        if len(nodes) < p.target_dedicated_nodes:
+        target = (p.target_dedicated_nodes or 0) + (p.target_low_priority_nodes or 0)
+
+        nodes = self._Nodes()
+        histogram = {}
+        for node in nodes:
+            name = self._Name(node.state)
+            histogram[name] = histogram.get(name, 0) + 1
+        self.changed = histogram != self.histogram
+        self.histogram = histogram
+        if self.changed:
+            self.info('Pool {}: {}/{} nodes: {}'.format(
+                self.pool_id, len(nodes), target,
+                ', '.join('{} {}'.format(n, state) for state, n in sorted(histogram.items()))))
+
+        failed = [node for node in nodes if node.state in self.failed_states]
+        if failed:
+            raise PoolStartError('{} node(s) in pool {} failed to start: {}'.format(
+                len(failed), self.pool_id,
+                ', '.join('{} ({})'.format(node.id, self._Name(node.state)) for node in failed)))
+
+        ready = sum(1 for node in nodes if node.state in self.target_states)
+        if self.min_fraction < 1.0:
+            return target > 0 and ready >= self.min_fraction * target
+        if len(nodes) < target:
             return False
+        return ready == len(nodes)
         
-        return all(node.state in self.target_states for node in nodes)
-        
-    def wait(self):
-        while not self.test():
-            time.sleep(5)
-        return
+    def wait(self, timeout_s=None):
+        t_max = None if timeout_s is None else time.time() + timeout_s
+        interval = self.min_poll
+        while True:
+            if self.test():
+                return
+            if t_max is not None and time.time() > t_max:
+                raise PoolStartError('Timed out waiting for pool {}'.format(self.pool_id))
+            interval = self.min_poll if self.changed else min(interval * self.backoff, self.max_poll)
+            self.debug('Next poll in {:.0f} s'.format(interval))
+            time.sleep(interval)
 
     def print_connection_info(self):
         if not self.user_params:
             return
         
         if self.test():
-            nodes = list(self.client.compute_node.list(self.pool_id))
+            nodes = self._Nodes("state eq 'idle'") or self._Nodes()
             login = self.client.compute_node.get_remote_login_settings(self.pool_id, nodes[0].id)
             self.user_params['ip_addr'] = login.remote_login_ip_address
             self.user_params['port'] = login.remote_login_port
@@ -73,11 +138,14 @@ class PoolCreator(StatusReporter):
     # This MUST match the VHD's OS
     AGENT_SKU_ID = 'batch.node.centos 7'
     
-    def __init__(self, group_name, batch_name, image_id, vm_size='Standard_H16r', verbosity=1):
+    def __init__(self, group_name, batch_name, image_id, vm_size='Standard_H16r', verbosity=1,
+                 helper=None):
         self.verbosity = verbosity
         
         self.account_name = batch_name
-        self.batch = batch.Helper(group_name, batch_name, verbosity=verbosity-1)
+        if helper is None:
+            helper = batch.Helper(group_name, batch_name, verbosity=verbosity-1)
+        self.batch = helper
         
         self.image_id = image_id
         self.image_ref = batch.models.ImageReference(
@@ -90,7 +158,21 @@ class PoolCreator(StatusReporter):
             node_agent_sku_id=self.AGENT_SKU_ID
             )
         
-    def __call__(self, pool_name, n_nodes, create_user=False, start_task=None):
+    def __call__(self, pool_name, n_nodes, create_user=False, start_task=None, autoscale=None,
+                 app_packages=None, datasets=None, tasks_per_node=1, low_priority_nodes=0):
+        '''Create the pool with n_nodes dedicated and low_priority_nodes
+        low-priority nodes, or, if an AutoScalePolicy is given, with
+        autoscaling and the node counts ignored. Low-priority nodes are
+        much cheaper but may be preempted - see
+        SubmittedJob.requeue_preempted.
+
+        Every node gets the AppPackages and Datasets given, once, when
+        it joins the pool - see PoolStaging.
+
+        With tasks_per_node > 1 each node runs that many tasks at once,
+        filling one node before the next, for packing small jobs - see
+        PackingScheduler. Multi-node MPI tasks need tasks_per_node = 1.
+        '''
         users = []
         user_params = {}
         if create_user:
@@ -106,20 +188,57 @@ class PoolCreator(StatusReporter):
             user_params['password'] = pw
             pass
 
+        app_packages = app_packages or []
+        for pkg in app_packages:
+            self.info('Installing application package {} to ${}'.format(pkg, pkg.env_var))
+        if datasets:
+            self.info('Staging data sets', ', '.join(str(ds) for ds in datasets))
+            staging = PoolStaging(self.batch.group, self.batch.name,
+                                  verbosity=self.verbosity-1, helper=self.batch)
+            start_task = staging.start_task(datasets, start_task)
+
         self.info('Configuring pool params')
+        if autoscale is None:
+            scale_params = dict(target_dedicated_nodes=n_nodes,
+                                target_low_priority_nodes=low_priority_nodes,
+                                enable_auto_scale=False)
+        else:
+            autoscale.validate()
+            formula = autoscale.formula()
+            self.debug('Autoscale formula:\n' + formula)
+            scale_params = dict(enable_auto_scale=True,
+                                auto_scale_formula=formula,
+                                auto_scale_evaluation_interval=autoscale.evaluation_interval)
+        # Fill each node's task slots before starting on the next node
+        scheduling = None
+        if tasks_per_node > 1:
+            scheduling = batch.models.TaskSchedulingPolicy(node_fill_type='pack')
         pool_conf = batch.models.PoolAddParameter(
             id=pool_name,
             vm_size=self.vm_size,
             virtual_machine_configuration=self.vm_conf,
-            target_dedicated_nodes=n_nodes,
-            enable_auto_scale=False,
             enable_inter_node_communication=True,
-            max_tasks_per_node=1,
+            max_tasks_per_node=tasks_per_node,
+            task_scheduling_policy=scheduling,
             user_accounts=users,
-            start_task=start_task)
+            start_task=start_task,
+            application_package_references=[pkg.reference() for pkg in app_packages] or None,
+            **scale_params)
         self.info('Creating pool', pool_name)
         self.batch.client.pool.add(pool_conf)
-        return PoolStartWaiter(self.batch.client, pool_name, user_params)
+        if autoscale is not None:
+            self.EvaluateAutoScale(pool_name, formula)
+        return PoolStartWaiter(self.batch.client, pool_name, user_params, verbosity=self.verbosity)
+
+    def EvaluateAutoScale(self, pool_name, formula):
+        '''Have the service evaluate a formula against a pool's live
+        metrics without applying it. Raises if the formula is invalid.
+        '''
+        run = self.batch.client.pool.evaluate_auto_scale(pool_name, formula)
+        if run.error is not None:
+            raise RuntimeError('Autoscale formula error {}: {}'.format(run.error.code, run.error.message))
+        self.info('Autoscale evaluation:', run.results)
+        return run.results
     
     pass
 
@@ -144,18 +263,49 @@ if __name__ == "__main__":
 
     parser.add_argument("--nodes", "-n", required=True, type=int,
                         help="Number of nodes to allocate")
+    parser.add_argument("--low-priority", "-l", default=0, type=int,
+                        help="Number of low-priority nodes to allocate as well")
 
     parser.add_argument("--no-wait", action="store_true",
                         help="Do not wait for the pool to provision and boot")
 
     parser.add_argument("--create-user", "-c", action="store_true",
                         help="Whether to create a user")
+    parser.add_argument("--min-fraction", default=1.0, type=float,
+                        help="Stop waiting once this fraction of the nodes are idle")
+
+    parser.add_argument("--app-package", action="append", default=[], metavar="ID[:VERSION]",
+                        help="Install this application package on every node - can be repeated")
+    parser.add_argument("--dataset", action="append", default=[], metavar="NAME:VERSION",
+                        help="Stage this data set on every node - can be repeated")
+
+    parser.add_argument("--tasks-per-node", default=1, type=int,
+                        help="Number of tasks each node runs at once")
+
+    parser.add_argument("--autoscale", "-a", action="store_true",
+                        help="Scale the pool with pending tasks, up to --nodes nodes, "
+                        "low-priority ones if --low-priority is not zero")
+    parser.add_argument("--min-nodes", default=0, type=int,
+                        help="Least nodes to keep when autoscaling")
+    parser.add_argument("--nodes-per-task", default=1, type=int,
+                        help="Nodes needed by each task when autoscaling")
+    parser.add_argument("--cooldown", default=15, type=int,
+                        help="Minutes of low demand before an autoscaling pool shrinks")
     args = parser.parse_args()
     verbosity = args.verbose - args.quiet + 1
 
     
-    pc = PoolCreator(args.resource_group, args.batch_account, args.image_id)
-    waiter = pc(args.pool_name, args.nodes, args.create_user)
+    pc = PoolCreator(args.resource_group, args.batch_account, args.image_id, verbosity=verbosity)
+    policy = None
+    if args.autoscale:
+        policy = AutoScalePolicy(min_nodes=args.min_nodes, max_nodes=args.nodes,
+                                 nodes_per_task=args.nodes_per_task, cooldown=args.cooldown,
+                                 low_priority=args.low_priority > 0)
+    waiter = pc(args.pool_name, args.nodes, args.create_user, autoscale=policy,
+                app_packages=[AppPackage.Parse(p) for p in args.app_package],
+                datasets=[Dataset.Parse(d) for d in args.dataset],
+                tasks_per_node=args.tasks_per_node, low_priority_nodes=args.low_priority)
+    waiter.min_fraction = args.min_fraction
     if not args.no_wait:
         waiter.wait()
         
@@ -0,0 +1,213 @@
+from __future__ import print_function, unicode_literals
+import os
+import re
+from six.moves.urllib.parse import urlsplit
+
+from ..az import batch
+from ..az.storage import blob, blob_models
+from ..common.lazy import LazyModule
+from ..status import StatusReporter
+
+mgmt_models = LazyModule('azure.mgmt.batch.models')
+
+class AppPackage(object):
+    '''A Batch application package to install on every node of a pool.
+
+    Batch unzips it once per node, when the node joins the pool, into
+    the directory named by the environment variable env_var. Without a
+    version the application's default version is used.
+    '''
+    def __init__(self, application_id, version=None):
+        self.application_id = application_id
+        self.version = version
+
+    @classmethod
+    def Parse(cls, text):
+        '''From "application_id" or "application_id:version"'''
+        app_id, _, version = text.partition(':')
+        return cls(app_id, version or None)
+
+    def reference(self):
+        return batch.models.ApplicationPackageReference(application_id=self.application_id,
+                                                        version=self.version)
+
+    @property
+    def env_var(self):
+        # As on Linux nodes: case kept, anything else flattened to _
+        name = self.application_id if self.version is None else self.application_id + '_' + self.version
+        return 'AZ_BATCH_APP_PACKAGE_' + re.sub('[^A-Za-z0-9]', '_', name)
+
+    def __str__(self):
+        return self.application_id if self.version is None else self.application_id + ':' + self.version
+    pass
+
+class Dataset(object):
+    '''A versioned directory tree in the account's storage that the
+    pool's start task copies to the local disk of each node.
+
+    The files of version v of data set d are the blobs under d/v/ in
+    the container. On the node they are in node_path.
+    '''
+    container_name = 'saje-pool-data'
+
+    def __init__(self, name, version):
+        if '/' in name or '/' in version:
+            raise ValueError('Data set name and version may not contain "/"')
+        self.name = name
+        self.version = version
+
+    @classmethod
+    def Parse(cls, text):
+        '''From "name:version"'''
+        name, sep, version = text.partition(':')
+        if not sep or not version:
+            raise ValueError('Data sets need a version, as name:version, got ' + text)
+        return cls(name, version)
+
+    @property
+    def prefix(self):
+        return '{}/{}/'.format(self.name, self.version)
+
+    @property
+    def node_path(self):
+        return '$AZ_BATCH_NODE_STARTUP_DIR/wd/datasets/' + self.prefix.rstrip('/')
+
+    def resource_files(self, container, sas):
+        return [batch.models.ResourceFile(blob_source=container.url(name, sas_token=sas),
+                                          file_path='datasets/' + name)
+                for name in container.list(prefix=self.prefix)]
+
+    def __str__(self):
+        return self.name + ':' + self.version
+    pass
+
+class PoolStaging(StatusReporter):
+    '''Publish application packages and data sets to a Batch account,
+    and turn them into the settings that put them on a pool's nodes.
+
+    Published versions are immutable: publishing a version that exists
+    is an error, so a pool built against a version always gets the
+    same bits.
+    '''
+    # Nodes rerun the start task when they join or reboot, so the data
+    # set SAS must last as long as the pool might
+    sas_hours = 24 * 365
+
+    def __init__(self, group_name, batch_name, verbosity=1, helper=None):
+        self.verbosity = verbosity
+        if helper is None:
+            helper = batch.Helper(group_name, batch_name, verbosity=verbosity-1)
+        self.batch = helper
+
+    def publish_package(self, application_id, version, zip_path, make_default=False):
+        '''Upload a zip file as a new version of an application,
+        creating the application if need be.
+        '''
+        from msrestazure.azure_exceptions import CloudError
+        mgr = self.batch.manager
+        group, account = self.batch.group, self.batch.name
+        try:
+            mgr.application.get(group, account, application_id)
+        except CloudError:
+            self.info('Creating application', application_id)
+            mgr.application.create(group, account, application_id)
+
+        try:
+            existing = mgr.application_package.get(group, account, application_id, version)
+        except CloudError:
+            existing = None
+        if existing is not None and getattr(existing.state, 'value', existing.state) == 'active':
+            raise ValueError('Version {} of application {} already exists'.format(version, application_id))
+
+        pkg = mgr.application_package.create(group, account, application_id, version)
+        self.info('Uploading', zip_path, 'as', application_id, version)
+        url = urlsplit(pkg.storage_url)
+        storage_name, _, suffix = url.netloc.split('.', 2)
+        container, blob_name = url.path.lstrip('/').split('/', 1)
+        svc = blob.BlockBlobService(account_name=storage_name, sas_token=url.query,
+                                    endpoint_suffix=suffix)
+        svc.create_blob_from_path(container, blob_name, zip_path)
+        mgr.application_package.activate(group, account, application_id, version, 'zip')
+
+        if make_default:
+            self.info('Making', version, 'the default version of', application_id)
+            mgr.application.update(group, account, application_id,
+                                   mgmt_models.ApplicationUpdateParameters(default_version=version))
+        return AppPackage(application_id, version)
+
+    def _Container(self):
+        return self.batch.storage.block_blob_service.create_container(Dataset.container_name)
+
+    def publish_dataset(self, name, version, local_dir, max_workers=None):
+        '''Upload every file below local_dir as a new version of a
+        data set.
+        '''
+        ds = Dataset(name, version)
+        cont = self._Container()
+        if any(True for _ in cont.list(prefix=ds.prefix)):
+            raise ValueError('Data set {} already exists'.format(ds))
+        items = []
+        for dirpath, dirnames, filenames in os.walk(local_dir):
+            for fn in filenames:
+                path = os.path.join(dirpath, fn)
+                rel = os.path.relpath(path, local_dir).replace(os.sep, '/')
+                items.append((path, ds.prefix + rel))
+        self.info('Uploading {} file(s) as data set {}'.format(len(items), ds))
+        cont.upload_many(items, max_workers=max_workers, verbosity=self.verbosity-1)
+        return ds
+
+    def start_task(self, datasets, start_task=None):
+        '''Return a start task that stages the data sets, adding them to
+        start_task if one is given. Nodes do not take tasks until it has
+        succeeded.
+        '''
+        cont = self.batch.storage.block_blob_service.get_container(Dataset.container_name)
+        sas = cont.generate_sas(blob_models.ContainerPermissions.READ, hours=self.sas_hours)
+        files = []
+        for ds in datasets:
+            ds_files = ds.resource_files(cont, sas)
+            if not ds_files:
+                raise ValueError('Data set {} does not exist'.format(ds))
+            self.debug('Staging {} file(s) of data set {}'.format(len(ds_files), ds))
+            files += ds_files
+        if start_task is None:
+            start_task = batch.models.StartTask(command_line='/bin/true')
+        start_task.resource_files = (start_task.resource_files or []) + files
+        start_task.wait_for_success = True
+        return start_task
+    pass
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Publish a new version of an application package or pool data set")
+    parser.add_argument("--verbose", "-v", action="count", default=0,
+                        help="Increase the verbosity level - can be provided multiple times")
+    parser.add_argument("--quiet", "-q", action="count", default=0,
+                        help="Decrease the verbosity level")
+
+    parser.add_argument("--resource-group", "-g", required=True,
+                        help="Name of resource group containing the batch account (required)")
+    parser.add_argument("--batch-account", "-b", required=True,
+                        help="Name of the batch account (required)")
+    what = parser.add_mutually_exclusive_group(required=True)
+    what.add_argument("--package", metavar="ZIP",
+                      help="Publish this zip file as an application package")
+    what.add_argument("--data", metavar="DIR",
+                      help="Publish the files below this directory as a data set")
+    parser.add_argument("--default", action="store_true",
+                        help="Make this the application's default version")
+    parser.add_argument("name",
+                        help="Application ID or data set name")
+    parser.add_argument("version",
+                        help="Version to publish")
+    args = parser.parse_args()
+    verbosity = args.verbose - args.quiet + 1
+
+    staging = PoolStaging(args.resource_group, args.batch_account, verbosity=verbosity)
+    if args.package:
+        pkg = staging.publish_package(args.name, args.version, args.package, make_default=args.default)
+        print('Published {}, unpacked on nodes to ${}'.format(pkg, pkg.env_var))
+    else:
+        ds = staging.publish_dataset(args.name, args.version, args.data)
+        print('Published {}, staged on nodes to {}'.format(ds, ds.node_path))
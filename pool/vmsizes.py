@@ -0,0 +1,67 @@
+from __future__ import print_function, division, unicode_literals
+import re
+
+class VmSize(object):
+    '''The hardware of an Azure VM size that matters for laying out MPI
+    ranks: cores, NUMA domains and the Intel MPI fabric for its RDMA
+    network, if it has one. family is the name Batch gives its core
+    quota family, where known.
+    '''
+    def __init__(self, name, cores, numa_nodes=1, rdma_fabric=None, family=None):
+        self.name = name
+        self.cores = cores
+        self.numa_nodes = numa_nodes
+        self.rdma_fabric = rdma_fabric
+        self.family = family
+
+    @property
+    def rdma(self):
+        return self.rdma_fabric is not None
+
+    @property
+    def cores_per_numa(self):
+        return self.cores // self.numa_nodes
+
+    @classmethod
+    def Get(cls, name):
+        '''Look up a size in the catalog, case insensitively. Sizes not
+        in it are guessed from the name: the first number is the core
+        count and an "r" among the letters after it means RDMA over
+        DAPL, as on the original H and A series. Their family is not
+        known.
+        '''
+        key = name.lower()
+        if key.startswith('standard_'):
+            key = key[len('standard_'):]
+        try:
+            return cls(name, *CATALOG[key])
+        except KeyError:
+            pass
+        m = re.match(r'^[a-z]+(\d+)([a-z]*)', key)
+        if m is None:
+            raise ValueError('Unknown VM size ' + name)
+        return cls(name, int(m.group(1)), 1, 'dapl' if 'r' in m.group(2) else None)
+
+    def __repr__(self):
+        return '<VmSize {} {} cores, {} NUMA, RDMA {}>'.format(
+            self.name, self.cores, self.numa_nodes, self.rdma_fabric)
+    pass
+
+# Name without "Standard_": (cores, NUMA domains, RDMA fabric, quota
+# family). The A and H series have a DAPL network, the SR-IOV
+# InfiniBand of HB and HC needs OFA
+CATALOG = {
+    'a8': (8, 1, 'dapl', 'standardA8_A11Family'),
+    'a9': (16, 2, 'dapl', 'standardA8_A11Family'),
+    'a10': (8, 1, None, 'standardA8_A11Family'),
+    'a11': (16, 2, None, 'standardA8_A11Family'),
+    'h8': (8, 1, None, 'standardHFamily'),
+    'h8m': (8, 1, None, 'standardHFamily'),
+    'h16': (16, 2, None, 'standardHFamily'),
+    'h16m': (16, 2, None, 'standardHFamily'),
+    'h16r': (16, 2, 'dapl', 'standardHFamily'),
+    'h16mr': (16, 2, 'dapl', 'standardHFamily'),
+    'hc44rs': (44, 2, 'ofa', 'standardHCSFamily'),
+    'hb60rs': (60, 15, 'ofa', 'standardHBSFamily'),
+    'hb120rs_v2': (120, 30, 'ofa', 'standardHBrsv2Family'),
+    }
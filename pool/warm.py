@@ -0,0 +1,216 @@
+from __future__ import print_function, division, unicode_literals
+import datetime
+import uuid
+
+from ..az import batch
+from ..status import StatusReporter
+from .create import PoolCreator, PoolStartWaiter
+
+def Name(state):
+    return getattr(state, 'value', state)
+
+class WarmPool(object):
+    '''What the WarmPoolManager knows about one pool: its image, VM
+    size, node counts and how long it has had nothing to do.
+    '''
+    def __init__(self, pool, nodes, n_jobs):
+        self.id = pool.id
+        self.vm_size = (pool.vm_size or '').lower()
+        vm_conf = pool.virtual_machine_configuration
+        image_ref = vm_conf.image_reference if vm_conf is not None else None
+        self.image_id = image_ref.virtual_machine_image_id if image_ref is not None else None
+        self.packages = set((ref.application_id, ref.version)
+                            for ref in pool.application_package_references or [])
+        self.steady = Name(pool.allocation_state) == 'steady'
+        self.autoscale = bool(pool.enable_auto_scale)
+        self.target = pool.target_dedicated_nodes or 0
+        self.tasks_per_node = pool.max_tasks_per_node or 1
+        self.size = len(nodes)
+        self.free = sum(1 for node in nodes if Name(node.state) == 'idle')
+        self.n_jobs = n_jobs
+        # Time since which the pool has been entirely idle, if it is
+        if n_jobs or self.free < self.size or not self.steady:
+            self.idle_since = None
+        elif nodes:
+            self.idle_since = max(node.state_transition_time for node in nodes)
+        else:
+            self.idle_since = pool.allocation_state_transition_time
+
+    def idle_for(self):
+        if self.idle_since is None:
+            return datetime.timedelta(0)
+        # The SDK returns timezone aware UTC times
+        when = self.idle_since
+        now = datetime.datetime.now(when.tzinfo) if when.tzinfo else datetime.datetime.utcnow()
+        return now - when
+
+    def __repr__(self):
+        return '<WarmPool {} {} {}/{} free, {} job(s)>'.format(
+            self.id, self.vm_size, self.free, self.size, self.n_jobs)
+    pass
+
+class WarmPoolManager(StatusReporter):
+    '''Find or make a pool for a job instead of requiring one by name.
+
+    Pools are matched on image ID, VM size and tasks per node, and must
+    have at least the application packages asked for. A job goes to the
+    matching pool with the fewest idle nodes that is still enough,
+    preferring pools with no active jobs. Failing that, one of our own
+    pools is grown, and failing that a new one is created.
+
+    Pools this class creates are named with the prefix and are the only
+    ones it resizes or deletes; any pool that has been wholly idle, with
+    no active jobs, for idle_minutes is deleted on the next acquire,
+    unless that acquire is about to use it, or reap. Two submissions racing for the same idle nodes is harmless:
+    Batch queues the later task until nodes free up.
+    '''
+    prefix = 'saje-warm-'
+    pool_fields = ('id,vmSize,virtualMachineConfiguration,state,allocationState,'
+                   'allocationStateTransitionTime,enableAutoScale,targetDedicatedNodes,'
+                   'maxTasksPerNode,applicationPackageReferences')
+    node_fields = 'id,state,stateTransitionTime'
+
+    def __init__(self, group_name, batch_name, image_id, vm_size='Standard_H16r',
+                 idle_minutes=30, app_packages=None, verbosity=1, helper=None):
+        self.verbosity = verbosity
+        if helper is None:
+            helper = batch.Helper(group_name, batch_name, verbosity=verbosity-1)
+        self.batch = helper
+        self.image_id = image_id
+        self.vm_size = vm_size
+        self.app_packages = app_packages or []
+        self.idle_time = None if idle_minutes is None else datetime.timedelta(minutes=idle_minutes)
+
+    def _Jobs(self):
+        '''Number of active jobs on each pool'''
+        opts = batch.models.JobListOptions(filter="state eq 'active'", select='id,poolInfo')
+        ans = {}
+        for job in self.batch.client.job.list(job_list_options=opts):
+            pool_id = job.pool_info.pool_id if job.pool_info is not None else None
+            if pool_id is not None:
+                ans[pool_id] = ans.get(pool_id, 0) + 1
+        return ans
+
+    def _Nodes(self, pool_id):
+        opts = batch.models.ComputeNodeListOptions(select=self.node_fields)
+        return list(self.batch.client.compute_node.list(pool_id, compute_node_list_options=opts))
+
+    def scan(self, all_images=False, tasks_per_node=1):
+        '''Return a WarmPool for each active pool, only those matching
+        our image, VM size and tasks_per_node unless all_images.
+        '''
+        jobs = self._Jobs()
+        opts = batch.models.PoolListOptions(select=self.pool_fields)
+        ans = []
+        for pool in self.batch.client.pool.list(pool_list_options=opts):
+            if Name(pool.state) != 'active':
+                continue
+            wp = WarmPool(pool, self._Nodes(pool.id), jobs.get(pool.id, 0))
+            if all_images or self.matches(wp, tasks_per_node):
+                ans.append(wp)
+        return ans
+
+    def matches(self, wp, tasks_per_node=1):
+        wanted = set((pkg.application_id, pkg.version) for pkg in self.app_packages)
+        return (wp.image_id == self.image_id and wp.vm_size == self.vm_size.lower()
+                and wp.tasks_per_node == tasks_per_node and wanted <= wp.packages)
+
+    def owned(self, wp):
+        return wp.id.startswith(self.prefix)
+
+    def acquire(self, n_nodes, tasks_per_node=1):
+        '''Return the ID of a pool with n_nodes idle nodes, resizing or
+        creating one if need be. Other idle pools are reaped once the
+        pool to use has been picked, so it is never one of them.
+        '''
+        all_pools = self.scan(all_images=True)
+        pools = [p for p in all_pools if self.matches(p, tasks_per_node)]
+        self.debug('Matching pools:', pools)
+
+        ready = [p for p in pools if p.steady and p.free >= n_nodes]
+        if ready:
+            best = min(ready, key=lambda p: (p.n_jobs > 0, p.free))
+            self.info('Using warm pool {} ({} of {} nodes idle)'.format(best.id, best.free, best.size))
+            self._ReapOthers(all_pools, best)
+            return best.id
+
+        growable = [p for p in pools if p.steady and self.owned(p) and not p.autoscale]
+        if growable:
+            best = max(growable, key=lambda p: p.free)
+            self._ReapOthers(all_pools, best)
+            return self._Resize(best, best.target + n_nodes - best.free, n_nodes)
+
+        # Reaping first frees quota for the new pool
+        self._ReapOthers(all_pools, None)
+        return self._Create(n_nodes, tasks_per_node)
+
+    def _ReapOthers(self, pools, keep):
+        if self.idle_time is not None:
+            self.reap(pools=[wp for wp in pools if keep is None or wp.id != keep.id])
+
+    def _Resize(self, wp, target, n_nodes):
+        self.info('Resizing pool {} from {} to {} nodes'.format(wp.id, wp.target, target))
+        self.batch.client.pool.resize(wp.id, batch.models.PoolResizeParameter(
+            target_dedicated_nodes=target))
+        # Wait for enough idle nodes, not for every node to be idle
+        waiter = PoolStartWaiter(self.batch.client, wp.id, min_fraction=n_nodes / target,
+                                 verbosity=self.verbosity)
+        waiter.wait()
+        return wp.id
+
+    def _Create(self, n_nodes, tasks_per_node=1):
+        pool_id = self.prefix + uuid.uuid4().hex[:12]
+        self.info('No suitable warm pool; creating', pool_id)
+        creator = PoolCreator(self.batch.group, self.batch.name, self.image_id, self.vm_size,
+                              verbosity=self.verbosity, helper=self.batch)
+        waiter = creator(pool_id, n_nodes, app_packages=self.app_packages,
+                         tasks_per_node=tasks_per_node)
+        waiter.wait()
+        return pool_id
+
+    def reap(self, dry_run=False, pools=None):
+        '''Delete our pools that have been idle for longer than
+        idle_minutes, from pools or from a fresh scan. Returns the IDs
+        of the pools deleted.
+        '''
+        if pools is None:
+            pools = self.scan(all_images=True)
+        doomed = [wp.id for wp in pools
+                  if self.owned(wp) and wp.idle_for() > self.idle_time]
+        for pool_id in doomed:
+            self.info('Deleting idle pool', pool_id)
+            if not dry_run:
+                self.batch.client.pool.delete(pool_id)
+        return doomed
+    pass
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="List warm pools and delete idle ones")
+    parser.add_argument("--verbose", "-v", action="count", default=0,
+                        help="Increase the verbosity level - can be provided multiple times")
+    parser.add_argument("--quiet", "-q", action="count", default=0,
+                        help="Decrease the verbosity level")
+
+    parser.add_argument("--resource-group", "-g", required=True,
+                        help="Name of resource group containing the batch account (required)")
+    parser.add_argument("--batch-account", "-b", required=True,
+                        help="Name of the batch account (required)")
+    parser.add_argument("--idle-minutes", default=30, type=float,
+                        help="Delete warm pools idle for longer than this")
+    parser.add_argument("--reap", action="store_true",
+                        help="Delete idle warm pools rather than just listing pools")
+    parser.add_argument("--dry-run", "-n", action="store_true",
+                        help="Only report which pools would be deleted")
+    args = parser.parse_args()
+    verbosity = args.verbose - args.quiet + 1
+
+    wpm = WarmPoolManager(args.resource_group, args.batch_account, None,
+                          idle_minutes=args.idle_minutes, verbosity=verbosity)
+    if args.reap:
+        wpm.reap(dry_run=args.dry_run)
+    else:
+        for wp in wpm.scan(all_images=True):
+            print(wp.id, wp.vm_size, '{}/{} idle'.format(wp.free, wp.size),
+                  '{} job(s)'.format(wp.n_jobs), wp.image_id)
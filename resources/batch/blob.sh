@@ -0,0 +1,48 @@
+# Access to blobs in the output container that fails loudly and copes
+# with any file name and any number of blobs
+function blob_urlencode {{
+    local LC_ALL=C s="$1" out="" c i
+    for ((i = 0; i < ${{#s}}; i++)); do
+        c="${{s:i:1}}"
+        case "$c" in
+            [a-zA-Z0-9/._~-]) out+="$c" ;;
+            *) out+=$(printf '%%%02X' "'$c") ;;
+        esac
+    done
+    printf '%s' "$out"
+}}
+
+# Print the names of the blobs under a prefix, one per line, listing
+# page by page
+function blob_list {{
+    local marker="" page
+    while :; do
+        page=$(curl -sSf "{output_container_url}?restype=container&comp=list&prefix=$(blob_urlencode "$1")${{marker:+&marker=$(blob_urlencode "$marker")}}&{output_sas}") || return 1
+        printf '%s' "$page" | grep -o '<Name>[^<]*</Name>' | \
+            sed -e 's/<[^>]*>//g' -e "s/&lt;/</g; s/&gt;/>/g; s/&quot;/\"/g; s/&apos;/'/g; s/&amp;/\&/g"
+        marker=$(printf '%s' "$page" | grep -o '<NextMarker>[^<]*</NextMarker>' | sed -e 's/<[^>]*>//g')
+        [[ -n $marker ]] || return 0
+    done
+}}
+
+# blob_get <blob name> <local path>
+function blob_get {{
+    mkdir -p "$(dirname "$2")"
+    curl -sSf -o "$2" "{output_container_url}/$(blob_urlencode "$1")?{output_sas}"
+}}
+
+# blob_put <local path> <blob name>
+function blob_put {{
+    local timestamp=$(TZ=GMT date '+%a, %d %h %Y %H:%M:%S %Z')
+    curl -sSf -H "x-ms-blob-type: BlockBlob" -H "Date: $timestamp" -H "x-ms-version: 2015-07-08" -T "$1" "{output_container_url}/$(blob_urlencode "$2")?{output_sas}"
+}}
+
+# blob_get_all <prefix> <local directory>: every blob under the prefix
+function blob_get_all {{
+    local names name
+    names=$(blob_list "$1") || return 1
+    while IFS= read -r name; do
+        [[ -n $name ]] || continue
+        blob_get "$name" "$2/${{name#$1}}" || return 1
+    done <<< "$names"
+}}
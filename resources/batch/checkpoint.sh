@@ -0,0 +1,26 @@
+# Restart files in {path} are kept in the output container under
+# {remote} so that a requeued task carries on where it left off
+function ckpt_restore {{
+    mkdir -p "{path}"
+    blob_get_all "{remote}" "{path}"
+}}
+
+function ckpt_save {{
+    # Only send files changed since the last save
+    local newer=() f status=0
+    touch .ckpt_next
+    if [[ -e .ckpt_stamp ]]; then newer=(-newer .ckpt_stamp); fi
+    while IFS= read -r -d '' f; do
+        blob_put "$f" "{remote}${{f#{path}/}}" || status=1
+    done < <(find "{path}" -type f "${{newer[@]}}" -print0)
+    # A failed upload is tried again next time
+    if [[ $status == 0 ]]; then mv .ckpt_next .ckpt_stamp; fi
+    return $status
+}}
+
+if ! ckpt_restore; then
+    echo "Could not restore checkpoint from {remote}" >&2
+    exit 1
+fi
+(while sleep {interval}; do ckpt_save; done) &
+ckpt_pid=$!
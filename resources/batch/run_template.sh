@@ -4,15 +4,15 @@
 num_nodes={num_nodes}
 num_cores={num_cores}
 cores_per_node={cores_per_node}
+num_ranks={num_ranks}
+ranks_per_node={ranks_per_node}
+threads_per_rank={threads_per_rank}
 
 # Set up MPI because the PATH etc isn't passed through by sudo
 . /opt/intel/impi/2017.2.174/intel64/bin/mpivars.sh
 
-# Set up Intel MPI to use RDMA network
-export MPI_ROOT=$I_MPI_ROOT
-export I_MPI_FABRICS=shm:dapl
-export I_MPI_DAPL_PROVIDER=ofa-v2-ib0
-export I_MPI_DYNAMIC_CONNECTION=0
+# Set up Intel MPI for this VM size and launch profile
+{launch_env}
 
 if [[ $num_nodes == 1 ]]; then
     export AZ_BATCH_HOST_LIST=localhost
@@ -24,14 +24,18 @@ fi
 
 function upld {{
     timestamp=$(TZ=GMT date '+%a, %d %h %Y %H:%M:%S %Z')
-    curl -H "x-ms-blob-type: BlockBlob" -H "Date: $timestamp" -H "x-ms-version: 2015-07-08" -T $1 "{output_container_url}/$1?{output_sas}"
+    curl -H "x-ms-blob-type: BlockBlob" -H "Date: $timestamp" -H "x-ms-version: 2015-07-08" -T $1 "{output_container_url}/{output_prefix}$1?{output_sas}"
 }}
 
 # Get inputs
 {input}
+{stage_fetch}
 
 # Execute commands
+{checkpoint_start}
 {commands}
+{checkpoint_stop}
+{stage_save}
 
 # Store outputs
 shopt -s nullglob
@@ -0,0 +1,21 @@
+# Files made by a stage of the job that others depend on are kept in
+# the output container under .stages/<stage>/ and fetched by them
+function stage_fetch {{
+    if ! blob_get_all ".stages/$1/" .; then
+        echo "Could not fetch the files of stage $1" >&2
+        return 1
+    fi
+}}
+
+function stage_save {{
+    # Everything made since the stage started
+    local f status=0
+    while IFS= read -r -d '' f; do
+        f="${{f#./}}"
+        blob_put "$f" ".stages/$1/$f" || status=1
+    done < <(find . -type f -newer .stage_stamp ! -name '.stage_*' ! -name '.ckpt_*' -print0)
+    if [[ $status != 0 ]]; then
+        echo "Could not save the files of stage $1" >&2
+    fi
+    return $status
+}}